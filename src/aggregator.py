@@ -1,25 +1,57 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import card_names
 import downloaders
 import json
 import logging
+import memo
+import multiprocessing
 import os
 import requests
+import snapshots
 import texttable
 import common
+from collections import Counter
+from datetime import datetime
 DEFAULT_MAX_CACHED_DAYS = 30
 PRICE_CACHE_FNAME = 'mtg_price_cache.yaml'
+FILES_PER_COUNT_TASK = 50  # Number of cube files each worker process counts before sending back its Counter
+
+
+def _count_cube_files(cube_paths):
+    """Counts the card names in several cube files, streaming each file one line at a time."""
+    counts = Counter()
+    for fpath in cube_paths:
+        with open(fpath, 'r') as fh:
+            counts.update(common.iter_cube_list(fh))
+    return counts
 
 
 class Aggregator(object):
 
-    def __init__(self, config, skip_downloads=False, update_throttled=False):
+    def __init__(self, config, skip_downloads=False, update_throttled=False, as_of=None, force_stages=False):
         self.num_other_cubes = None  # int (None when uninitialized)
         self._skip_downloads = skip_downloads
         self._update_throttled = update_throttled
+        self._as_of = as_of  # Aggregate the cubetutor lists as they were on this date (YYYY-MM-DD)
+        self._all_sets_json = None  # Only read from disk when a stage that needs it is not cached
+        self._name_index = None
         self.grouping_specs = {}                # Specified in config
+        self.stage_cache = memo.StageCache.from_config(config, force_stages)
+        self.cards_key = None                   # Hash of all of the inputs to self.cards
+        self.cube_names = dict(config['cubetutor_ids'])  # {CUBE_ID: CUBE_NAME}
+        self._cube_paths = {}                   # {CUBE_ID: CUBE_FILE_PATH} (empty when aggregating as_of a date)
+        self._canonical_names = {}              # {NAME_IN_CUBE_LIST: CARD_NAME_IN_self.cards}
+        self._store = snapshots.SnapshotStore.from_config(config)
         card_map = self._aggregate_data(config)
         self.cards = card_map                   # {card_name: card_object}
+        self.stage_cache.save()
+
+    def _load_card_catalogue(self, config):
+        if self._all_sets_json is None:
+            self._all_sets_json = common.read_mtg_json_data(config['all_mtg_sets_path'])
+            self._name_index = card_names.CardNameIndex(self._all_sets_json, config.get('card_name_aliases'))
+        return self._all_sets_json, self._name_index
 
     def _get_other_cube_lists(self, config):
         if self._skip_downloads:
@@ -35,48 +67,129 @@ class Aggregator(object):
                 config['cache_dir']).fetch_updated_cubetutor_lists(config['cubetutor_ids'])
         return other_cube_paths
 
-    def _count_cards(self, other_cube_paths):
+    def _count_cards(self, other_cube_paths, workers=1):
         """Counts the number of times each card appears in the Cubetutor card lists.
 
+        With workers > 1, the files are split into tasks of FILES_PER_COUNT_TASK files that are counted by a
+        process pool. The partial Counters are merged in file order, so the result is identical either way.
+
         Returns:
             A dictionary mapping the card name to the number of occurrences
         """
-        card_dict = {}
-        for fpath in other_cube_paths:
-            with open(fpath, 'r') as fh:
-                cube_list = [l.strip() for l in fh.readlines() if l.strip() != "" and not l.startswith("#")]
-            for card in cube_list:
-                if card in card_dict:
-                    card_dict[card] += 1
-                else:
-                    card_dict[card] = 1
-        return card_dict
+        tasks = [other_cube_paths[i:i + FILES_PER_COUNT_TASK]
+                 for i in range(0, len(other_cube_paths), FILES_PER_COUNT_TASK)]
+        card_dict = Counter()
+        if workers > 1 and len(tasks) > 1:
+            with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+                for partial in pool.imap(_count_cube_files, tasks):
+                    card_dict.update(partial)
+        else:
+            for task in tasks:
+                card_dict.update(_count_cube_files(task))
+        return dict(card_dict)
 
     def _aggregate_data(self, config):
         # Load the config file
         self.grouping_specs = config['grouping_specs']
 
         # Gather and Organize Information
-        other_cube_paths = self._get_other_cube_lists(config)
-        self.num_other_cubes = len(other_cube_paths)
-        all_sets_json = common.read_mtg_json_data(config['all_mtg_sets_path'])
-
-        count_map = self._count_cards(other_cube_paths)
-        card_map = common.search_json_for_cards(count_map.keys(), all_sets_json)
-        for card_name in card_map:
-            card_map[card_name].json[common.OCCUR_STR] = count_map[card_name]
-
-        pf = downloaders.PriceFetcher(
-            os.path.join(config['cache_dir'], PRICE_CACHE_FNAME),
-            config.get('max_cached_days', DEFAULT_MAX_CACHED_DAYS), all_sets_json)
-        if not self._skip_downloads:
-            pf.bulk_query_price(list(card_map.values()), self._update_throttled)
-
-        # Update Card JSON data with price info
-        for card in card_map.values():
-            cache_entry = pf.price_cache.get(card.name)
-            if cache_entry is not None:
-                cache_entry = cache_entry['price']
-            card.json['price_raw'] = cache_entry if cache_entry is not None else None
-            card.json['price'] = '${:,.2f}'.format(cache_entry) if cache_entry is not None else None
-        return card_map
+        sc = self.stage_cache
+        if self._as_of:
+            missing = [cid for cid in config['cubetutor_ids'] if self._store.snapshot_as_of(cid, self._as_of) is None]
+            if len(missing) == len(config['cubetutor_ids']):
+                raise RuntimeError('None of the cubetutor lists have a snapshot from on or before {}'.format(
+                    self._as_of))
+            for cid in missing:
+                logging.warn('Cube {} ({}) has no snapshot from on or before {}, so it is left out'.format(
+                    cid, self.cube_names[cid], self._as_of))
+            self.num_other_cubes, count_map = self._store.count_cards_as_of(config['cubetutor_ids'], self._as_of)
+            count_key = sc.key('count_as_of', self._as_of, sorted(count_map.items()))
+        else:
+            other_cube_paths = self._get_other_cube_lists(config)
+            for cid, fpath in zip(config['cubetutor_ids'], other_cube_paths):
+                self._store.add_snapshot(cid, fpath)
+                self._cube_paths[cid] = fpath
+            self.num_other_cubes = len(other_cube_paths)
+            count_key = sc.key('count', [sc.file_digest(fpath) for fpath in other_cube_paths])
+            count_map = sc.get_or_compute('count', count_key, lambda: self._count_cards(
+                other_cube_paths, config.get('count_workers', 1)))
+
+        def look_up_cards():
+            all_sets_json, name_index = self._load_card_catalogue(config)
+            canonical_counts = name_index.canonicalize_counts(count_map)
+            card_map = common.search_json_for_cards(canonical_counts.keys(), all_sets_json, name_index)
+            for card_name in card_map:
+                card_map[card_name].json[common.OCCUR_STR] = canonical_counts[card_name]
+            return card_map, {name: name_index.resolve(name) or name for name in count_map}
+
+        lookup_key = sc.key('card_lookup', count_key, sc.file_digest(config['all_mtg_sets_path']),
+                            config.get('card_name_aliases'))
+        card_map, self._canonical_names = sc.get_or_compute('card_lookup', lookup_key, look_up_cards)
+
+        price_cache_path = os.path.join(config['cache_dir'], PRICE_CACHE_FNAME)
+        # With background_price_refresh, price_refresher.py keeps the price cache up to date instead
+        if not self._skip_downloads and not config.get('background_price_refresh', False):
+            self._query_outdated_prices(config, card_map, lookup_key, price_cache_path)
+
+        def join_prices():
+            # Update Card JSON data with price info
+            price_cache = common.read_price_cache(price_cache_path)
+            for card in card_map.values():
+                cache_entry = price_cache.get(card.name)
+                if cache_entry is not None:
+                    cache_entry = cache_entry['price']
+                card.json['price_raw'] = cache_entry if cache_entry is not None else None
+                card.json['price'] = '${:,.2f}'.format(cache_entry) if cache_entry is not None else None
+            return card_map
+
+        self.cards_key = sc.key('price_join', lookup_key, sc.file_digest(price_cache_path))
+        return sc.get_or_compute('price_join', self.cards_key, join_prices)
+
+    def _query_outdated_prices(self, config, card_map, lookup_key, price_cache_path):
+        """Queries the prices of the cards whose cached prices are missing or outdated.
+
+        Creating a PriceFetcher (i.e. reading AllSets.json & building every web source's setname_map) is skipped
+        when no price needs to be queried. Cards that no web source lists never get a cached price, so they
+        are remembered in the stage cache instead of being treated as outdated on every run.
+        """
+        sc = self.stage_cache
+        max_cached_days = config.get('max_cached_days', DEFAULT_MAX_CACHED_DAYS)
+        fetcher = []
+
+        def price_fetcher():
+            if not fetcher:
+                all_sets_json, name_index = self._load_card_catalogue(config)
+                fetcher.append(downloaders.PriceFetcher(price_cache_path, max_cached_days, all_sets_json, name_index))
+            return fetcher[0]
+
+        def find_outdated():
+            price_cache = common.read_price_cache(price_cache_path)
+            return sorted(name for name in card_map if not downloaders.is_cached_price_current(
+                price_cache.get(name), max_cached_days, self._update_throttled))
+
+        outdated_key = sc.key('outdated_prices', lookup_key, sc.file_digest(price_cache_path),
+                              datetime.now().strftime('%Y-%m-%d'), max_cached_days, self._update_throttled)
+        outdated = sc.get_or_compute('outdated_prices', outdated_key, find_outdated)
+        if outdated:
+            unpriceable = sc.get_or_compute('unpriceable', sc.key('unpriceable', lookup_key),
+                                            lambda: price_fetcher().unpriceable_names(card_map))
+            outdated = [name for name in outdated if name not in unpriceable]
+        if outdated:
+            price_fetcher().bulk_query_price([card_map[name] for name in outdated], self._update_throttled)
+
+    def iter_cube_memberships(self):
+        """Yields (CUBE_ID, CARD_NAME, COUNT) for every card in every aggregated cubetutor list.
+
+        The card lists are streamed from the cube files (or the snapshot store), one cube at a time.
+        """
+        for cid in self.cube_names:
+            if self._as_of:
+                counts = self._store.cube_counts_as_of(cid, self._as_of)
+            else:
+                with open(self._cube_paths[cid], 'r') as fh:
+                    counts = Counter(common.iter_cube_list(fh))
+            merged = Counter()
+            for name, count in counts.items():
+                merged[self._canonical_names.get(name, name)] += count
+            for card_name, count in merged.items():
+                yield cid, card_name, count
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Attributes derived from a card's JSON, computed once per card and stored in Card.derived
+
+New derived attributes and custom grouping filters are added by registering functions here:
+
+    @derived_attribute('is_cheap')
+    def _is_cheap(card_json):
+        return card_json.get('convertedManaCost', 0) <= 2
+
+    @custom_filter('cheap')
+    def _cheap(attrs):
+        return attrs['is_cheap']
+
+after which a grouping spec can use "filters: {custom: 'cheap'}".
+"""
+import logging
+import re
+NUM_MAP = {'a': 'ONE', 'two': 'TWO', 'three': 'THREE', 'four': 'FOUR'}
+TOKEN_REGEX = re.compile(r'(C|c)reate (a|two|three|four) ([^.]+)( creature)? tokens?')
+
+# Card.json fields that are also stored as bitsets, with the symbols each bit stands for. A "manaCost" bit is
+# set when the symbol appears anywhere in the mana cost (e.g. "{W/U}" sets W and U), and a "types" bit when
+# the type is one of the card's types.
+MANA_SYMBOLS = ('W', 'U', 'B', 'R', 'G', 'C', 'X', 'S', 'P')
+CARD_TYPES = ('Artifact', 'Creature', 'Enchantment', 'Instant', 'Land', 'Planeswalker', 'Sorcery', 'Tribal')
+BITSET_FIELDS = {
+    # Card.json KEY: (DERIVED ATTRIBUTE, SYMBOLS)
+    'manaCost': ('mana_symbols', MANA_SYMBOLS),
+    'types': ('type_flags', CARD_TYPES),
+}
+
+DERIVED_ATTRIBUTES = {}  # {ATTRIBUTE_NAME: FUNCTION(card_json) --> value}
+CUSTOM_FILTERS = {}      # {FILTER_NAME: FUNCTION(derived_attributes) --> bool}
+
+
+def derived_attribute(name):
+    def register(func):
+        DERIVED_ATTRIBUTES[name] = func
+        return func
+    return register
+
+
+def custom_filter(name):
+    def register(func):
+        CUSTOM_FILTERS[name] = func
+        return func
+    return register
+
+
+def symbols_to_bits(symbols, vocabulary):
+    """Returns the bitset for the symbols, or None if any of them is not in the vocabulary."""
+    bits = 0
+    for symbol in symbols:
+        if symbol not in vocabulary:
+            return None
+        bits |= 1 << vocabulary.index(symbol)
+    return bits
+
+
+@derived_attribute('color_count')
+def _color_count(card_json):
+    return len(card_json.get('colors', []))
+
+
+@derived_attribute('adjusted_cmc')
+def _adjusted_cmc(card_json):
+    # Each X counts as 100 in the convertedManaCost, so X spells sort after everything else
+    return 100 * card_json.get('manaCost', '').count('{X}') + int(card_json.get('convertedManaCost', 0))
+
+
+@derived_attribute('mana_symbols')
+def _mana_symbols(card_json):
+    mana_cost = card_json.get('manaCost', '')
+    return symbols_to_bits([symbol for symbol in MANA_SYMBOLS if symbol in mana_cost], MANA_SYMBOLS)
+
+
+@derived_attribute('type_flags')
+def _type_flags(card_json):
+    return symbols_to_bits([t for t in card_json.get('types', []) if t in CARD_TYPES], CARD_TYPES)
+
+
+@derived_attribute('tokens')
+def _tokens(card_json):
+    if 'text' in card_json:
+        matches = TOKEN_REGEX.findall(card_json['text'])
+        if matches and len(matches[0]) >= 3:
+            return '{} {}'.format(NUM_MAP[matches[0][1]], matches[0][2])
+    return ''
+
+
+@custom_filter('3+_colors')
+def _three_plus_colors(attrs):
+    return attrs['color_count'] >= 3
+
+
+def derive(card):
+    """Computes (or recomputes) every derived attribute of the card."""
+    card.derived = {name: func(card.json) for name, func in DERIVED_ATTRIBUTES.items()}
+    card.json['tokens'] = card.derived['tokens']
+    return card.derived
+
+
+def get_derived(card):
+    return card.derived if getattr(card, 'derived', None) is not None else derive(card)
+
+
+def matches_custom_filter(card, filter_name):
+    if filter_name not in CUSTOM_FILTERS:
+        logging.error('Unrecognized custom filer: {}'.format(filter_name))
+        return None
+    return CUSTOM_FILTERS[filter_name](get_derived(card))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import difflib
+import logging
+import re
+import unicodedata
+from collections import Counter
+FUZZY_CUTOFF = 0.85        # Minimum difflib ratio for a fuzzy match to be accepted
+FUZZY_CANDIDATES = 10      # Number of names (with the most trigrams in common) that are scored with difflib
+SPLIT_LAYOUTS = ('split', 'aftermath')  # Layouts whose name is every face's name (e.g. "Fire // Ice")
+FRONT_FACE_LAYOUTS = ('transform', 'double-faced', 'flip', 'adventure')  # Layouts known by their front face
+_FOLDED_CHARS = {'æ': 'ae', 'Æ': 'ae', '’': "'", '‘': "'", '“': '"', '”': '"'}
+
+
+def normalize_name(name):
+    """Folds case, diacritics, ligatures, quotes and whitespace so equivalent spellings compare equal.
+
+    E.g. "Æther Vial" --> "aether vial" | "Lim-Dûl's Vault" --> "lim-dul's vault" | "Fire//Ice" --> "fire // ice"
+    """
+    for char, replacement in _FOLDED_CHARS.items():
+        name = name.replace(char, replacement)
+    name = ''.join(c for c in unicodedata.normalize('NFKD', name) if not unicodedata.combining(c))
+    faces = [re.sub(r'\s+', ' ', face).strip() for face in name.casefold().split('/') if face.strip()]
+    return ' // '.join(faces)
+
+
+def card_faces(card_json):
+    """Returns the names of every face of a card (a single name for normal cards).
+
+    Meld cards are separate cards (their "names" also lists the cards they meld with), so they have one face.
+    """
+    if card_json.get('names') and card_json.get('layout') in SPLIT_LAYOUTS + FRONT_FACE_LAYOUTS:
+        return card_json['names']
+    return card_json['name'].split(' // ')
+
+
+def canonical_catalogue_name(card_json):
+    """The name a card is known by in this project.
+
+    Split cards use all of their faces (E.g. "Fire // Ice"). Double-faced, flip and adventure cards use their
+    front face (E.g. "Delver of Secrets"). Every other card (including meld cards) uses its own name.
+    """
+    faces = card_faces(card_json)
+    if card_json.get('layout') in SPLIT_LAYOUTS:
+        return ' // '.join(faces)
+    return faces[0]
+
+
+def _trigrams(normalized_name):
+    padded = '  {} '.format(normalized_name)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CardNameIndex(object):
+    """Resolves the card names found in cube lists to the names of cards in the MTG JSON catalogue.
+
+    Built once from the catalogue. Exact lookups (after normalize_name) are a single dictionary lookup, and
+    names with typos fall back to a trigram index whose best candidates are scored with difflib.
+    """
+
+    def __init__(self, all_sets_json, aliases=None):
+        self._keys = {}       # {NORMALIZED_NAME: CANONICAL_NAME} | E.g. {'ice': 'Fire // Ice'}
+        self._printings = {}  # {CANONICAL_NAME: [(SET_KEY, CARD_JSON), ...]}
+        self._resolved = {}   # {NAME: CANONICAL_NAME or None} for every name resolved so far
+        self._trigram_index = None  # {TRIGRAM: [NORMALIZED_NAME, ...]} (built on first fuzzy lookup)
+
+        for set_key, set_content in all_sets_json.items():
+            for card_json in set_content['cards']:
+                canonical = canonical_catalogue_name(card_json)
+                faces = card_faces(card_json)
+                if card_json.get('layout') in SPLIT_LAYOUTS or card_json['name'] == canonical:
+                    self._printings.setdefault(canonical, []).append((set_key, card_json))
+                for key in [canonical, card_json['name'], ' // '.join(faces)] + faces:
+                    self._keys.setdefault(normalize_name(key), canonical)
+
+        for alias, target in (aliases or {}).items():
+            canonical = self._keys.get(normalize_name(target))
+            if canonical is None:
+                logging.error('The alias "{}" points to an unknown card: "{}"'.format(alias, target))
+            else:
+                self._keys[normalize_name(alias)] = canonical
+
+    def resolve(self, name):
+        """Returns the canonical name of the card, or None if it cannot be found."""
+        if name in self._resolved:
+            return self._resolved[name]
+        normalized = normalize_name(name)
+        canonical = self._keys.get(normalized)
+        if canonical is None:
+            canonical = self._fuzzy_lookup(normalized)
+            if canonical is not None:
+                logging.warning('Resolved the unknown card name "{}" to "{}"'.format(name, canonical))
+        self._resolved[name] = canonical
+        return canonical
+
+    def _fuzzy_lookup(self, normalized):
+        if self._trigram_index is None:
+            self._trigram_index = {}
+            for key in self._keys:
+                for trigram in _trigrams(key):
+                    self._trigram_index.setdefault(trigram, []).append(key)
+
+        shared = Counter()
+        for trigram in _trigrams(normalized):
+            shared.update(self._trigram_index.get(trigram, ()))
+        best_ratio, best_key = 0, None
+        for key, _ in shared.most_common(FUZZY_CANDIDATES):
+            ratio = difflib.SequenceMatcher(None, normalized, key).ratio()
+            if ratio > best_ratio:
+                best_ratio, best_key = ratio, key
+        return self._keys[best_key] if best_ratio >= FUZZY_CUTOFF else None
+
+    def catalogue_order(self, canonical_names):
+        """Sorts canonical names by where each card first appears in the catalogue."""
+        positions = {name: i for i, name in enumerate(self._printings)}
+        return sorted(canonical_names, key=lambda name: positions.get(name, len(positions)))
+
+    def printings(self, canonical_name):
+        """Returns [(SET_KEY, CARD_JSON), ...] in catalogue order. Split cards have one CARD_JSON per face."""
+        return self._printings.get(canonical_name, [])
+
+    def canonicalize_counts(self, count_map):
+        """Merges the counts of cube list names that resolve to the same card under the card's canonical name.
+
+        Names that cannot be resolved are kept as they are.
+        """
+        merged = {}
+        for name, count in count_map.items():
+            canonical = self.resolve(name) or name
+            merged[canonical] = merged.get(canonical, 0) + count
+        return merged
@@ -1,13 +1,16 @@
+import card_attributes
+import card_names
+import contextlib
+import copy
+import fcntl
 import json
 import logging
 import os
-import re
 import shutil
 import yaml
 from datetime import datetime
 from send2trash import send2trash
 OCCUR_STR = 'occurrences'
-NUM_MAP = {'a': 'ONE', 'two': 'TWO', 'three': 'THREE', 'four': 'FOUR'}
 
 
 class Card(object):
@@ -16,17 +19,14 @@ class Card(object):
         self.name = name
         self.json = card_json
         self.sets = [mtg_sets] if mtg_sets else None
+        self.derived = None  # {ATTRIBUTE_NAME: VALUE} (see card_attributes.py)
         # Occurrences are kept in the self.json dictionary to take advantage of code in 
         # "groupings.py" that filters and sorts by fields in Card.json
         # TODO: There's probably a better way to do this ...
         if occurrences:
             self.json.update({OCCUR_STR: occurrences})
 
-        self.json['tokens'] = ''
-        if 'text' in self.json:
-            matches = re.findall(r'(C|c)reate (a|two|three|four) ([^.]+)( creature)? tokens?', self.json['text'])
-            if matches and len(matches[0]) >= 3:
-                self.json['tokens'] = '{} {}'.format(NUM_MAP[matches[0][1]], matches[0][2])
+        self.json['tokens'] = ''  # Set by card_attributes.derive()
 
     def __str__(self):
         answer = type(self).__name__ + '('
@@ -45,11 +45,29 @@ class Card(object):
             self.json['colors'] += new_json['colors']
 
 
+def iter_cube_list(fh):
+    """Yields the card names in an open cube list file (skipping blank lines and "#" comments)."""
+    for line in fh:
+        if line.startswith('#'):
+            continue
+        card = line.strip()
+        if card != '':
+            yield card
+
+
 def read_mtg_json_data(json_path):
     with open(json_path, 'r') as fh:
         return json.loads(fh.read())
 
 
+def atomic_write(fpath, text):
+    """Writes text to a file such that readers only ever see the old or the new contents."""
+    tmp_path = '{}.tmp{}'.format(fpath, os.getpid())
+    with open(tmp_path, 'w') as fh:
+        fh.write(text)
+    os.replace(tmp_path, fpath)
+
+
 def read_price_cache(cache_file_path):
     # Read in local cache of MTG card prices
     if os.path.exists(cache_file_path):
@@ -59,51 +77,69 @@ def read_price_cache(cache_file_path):
         return {}
 
 
-def save_to_price_cache(price_cache, cache_file_path):
-    to_be_trashed_fpath = str(datetime.now()) + '_' + os.path.basename(cache_file_path)
-    os.rename(cache_file_path, to_be_trashed_fpath)
-    send2trash(to_be_trashed_fpath)
-    with open(cache_file_path, 'w') as fh:
-        fh.write(yaml.dump(price_cache))
+@contextlib.contextmanager
+def price_cache_lock(cache_file_path):
+    """Serializes writers of the price cache (e.g. cube_stats.py and price_refresher.py)."""
+    with open(cache_file_path + '.lock', 'w') as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+
+def save_to_price_cache(price_cache, cache_file_path, backup=True):
+    """Merges price_cache into the cache file, which is replaced atomically so readers see a consistent snapshot.
+
+    Entries that another process saved with a newer date than ours are kept (and copied into price_cache).
+    """
+    with price_cache_lock(cache_file_path):
+        if os.path.exists(cache_file_path):
+            if backup:
+                to_be_trashed_fpath = str(datetime.now()) + '_' + os.path.basename(cache_file_path)
+                shutil.copy2(cache_file_path, to_be_trashed_fpath)
+                send2trash(to_be_trashed_fpath)
+            for card_name, entry in read_price_cache(cache_file_path).items():
+                if card_name not in price_cache or entry['date'] > price_cache[card_name]['date']:
+                    price_cache[card_name] = entry
+        atomic_write(cache_file_path, yaml.dump(price_cache))
 
 
-def search_json_for_cards(card_names_to_find, all_sets_json):
-    """Searches the tens of MBs of JSON of All MTG Sets only ONCE for all cube cards.
+def search_json_for_cards(card_names_to_find, all_sets_json, name_index=None):
+    """Looks up every cube card in the JSON of All MTG Sets.
 
-    (Excepting split cards)
+    The tens of MBs of JSON are only scanned once, to build the CardNameIndex (unless one is passed in).
 
     Args:
         all_sets_json: https://mtgjson.com/json/AllSets.json.zip (already unzipped)
+        name_index: CardNameIndex built from all_sets_json
     """
+    if name_index is None:
+        name_index = card_names.CardNameIndex(all_sets_json)
     card_map = {}  # Key = name of card | Value = Python Card() object | E.g. {"Giant Spider": Card(json=...)}
-    lower_card_dict = {card.lower(): card for card in card_names_to_find}  # E.g. {"giant spider": "Giant Spider"}
-
-    split_cards_lower = {}  # E.g. {"fire": "Fire // Ice", "ice": "Fire // Ice"}
-    for card_name in card_names_to_find:
-        if ' // ' in card_name:
-            for part in card_name.split(' // '):
-                split_cards_lower[part.lower()] = card_name
-    
-    for set_key, set_content in all_sets_json.items():
-        for card_json in set_content['cards']:
-            if card_json['name'].lower() in lower_card_dict:
-                name = lower_card_dict[card_json['name'].lower()]
-                if name not in card_map:
-                    card_map[name] = Card(name, card_json, set_key)
-                else:
-                    card_map[name].sets.append(set_key)
-            elif card_json['name'].lower() in split_cards_lower:
-                name = split_cards_lower[card_json['name'].lower()]
-                if name not in card_map:
-                    card_map[name] = Card(name, card_json, set_key)
-                else:
-                    # Each split card occurs only twice in each set
-                    if len(card_map[name].sets) == 1 and set_key in card_map[name].sets:
-                        card_map[name].merge_split_card_data(card_json)
-                    elif set_key not in card_map[name].sets:
-                        card_map[name].sets.append(set_key)
 
+    names_by_canonical = {}  # E.g. {"Fire // Ice": ["Fire // Ice", "Fire/Ice"]}
     for name in card_names_to_find:
-        if name not in card_map:
+        canonical = name_index.resolve(name)
+        if canonical is None:
             logging.error('The card "{}" appeared in No Sets'.format(name))
+        else:
+            names_by_canonical.setdefault(canonical, []).append(name)
+
+    # Cards are added in catalogue order, which is the order of ties when the cards are sorted into groupings
+    for canonical in name_index.catalogue_order(names_by_canonical):
+        for name in names_by_canonical[canonical]:
+            for set_key, card_json in name_index.printings(canonical):
+                if name not in card_map:
+                    card_map[name] = Card(name, copy.deepcopy(card_json), set_key)
+                elif set_key not in card_map[name].sets:
+                    card_map[name].sets.append(set_key)
+                elif card_map[name].sets == [set_key] and \
+                        card_json['name'] not in card_map[name].json['name'].split(' // '):
+                    # The other half of a split card (each split card occurs only twice in each set)
+                    card_map[name].merge_split_card_data(card_json)
+
+    # Derived after the halves of split cards are merged
+    for card in card_map.values():
+        card_attributes.derive(card)
     return card_map
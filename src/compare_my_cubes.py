@@ -1,60 +1,107 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+"""Compares N of my cubes against M sets of reference stats (the grouping CSVs written by cube_stats.py)
+
+Every card gets an index, and its data is kept in columns indexed by it: an array of counts per reference
+stats set, an array of prices, and one int bitset per cube list / group / reference stats set (bit i is set
+when card i is a member). Summaries are then computed with bitwise operations and sums over the arrays.
+
+Config:
+    price_cache_path: _cube_cache/mtg_price_cache.yaml
+    cubes:             # My cubes. Each one's stats_csvs is used as a reference stats set named after the cube
+      Legacy: {my_card_list: inputs/my_legacy_cube.csv, stats_csvs: outputs/legacy_csvs/}
+    reference_stats:   # (Optional) Reference stats sets to use instead of the cubes' stats_csvs
+      Legacy: outputs/legacy_csvs/
+    output_dir: outputs/comparison_csvs/
+    summary_top_n: 50  # (Optional) Number of most-missing cards to list for each of my cubes
+"""
+import argparse
 import csv
+import math
 import os
 import texttable
 import yaml
+from array import array
 from collections import namedtuple
-from common import Card
 from common import read_price_cache
 IncludedCard = namedtuple('IncludedCard', ['name', 'group', 'more'])
+DEFAULT_SUMMARY_TOP_N = 50
+SUMMARY_DIR = 'summary'
 
 
-class PossibleCard(Card):
+def _bits_to_indexes(bits):
+    """Yields the indexes of the set bits, lowest first."""
+    while bits:
+        low_bit = bits & -bits
+        yield low_bit.bit_length() - 1
+        bits ^= low_bit
 
-    def __init__(self, name, my_cube_occurs, total_occur, tokens):
-        super().__init__(name, {}, None, None)
-        self.occur_per_cube = my_cube_occurs  # {CUBE_NAME: OCCUR_STR} | E.g. {'Legacy': '3/7'}
-        self.total_occur = total_occur        # Total occurances across all of my cubes that I'm comparing
-        self.tokens = tokens 
 
-    def get_occurences(self, cube_names):
-        return [self.occur_per_cube[cname] if cname in self.occur_per_cube else '' for cname in cube_names]
+def _popcount(bits):
+    return bin(bits).count('1')
 
 
 class Comparer(object):
 
     def __init__(self, config):
         self.config = config     # Loaded configuration file (as python dictionary)
+        self.cube_names = list(config['cubes'])  # My cubes. E.g. ['Legacy', 'Vinetage']
+        # Reference stats sets. E.g. {'Legacy': 'outputs/legacy_csvs/', 'Vinetage': 'outputs/vintage_csvs/'}
+        self.reference_dirs = config.get('reference_stats') or \
+            {name: cube['stats_csvs'] for name, cube in config['cubes'].items()}
+        self.ref_names = list(self.reference_dirs)
         self.my_cube_lists = {}  # E.g. {'Legacy': [IncludedCard(...), IncludedCard(...), ...]}
-        self.group_lists = {}    # E.g. {'simic': [PossibleCard(...), PossibleCard(...), ...]}
 
-    def update_group_list(self, group_name, cube_name, csv_path):
-        possible_cards = self.group_lists.get(group_name, {})
+        # Card columns (all indexed by the card's index)
+        self.card_names = []     # [CARD_NAME, ...]
+        self._card_index = {}    # {CARD_NAME: CARD_INDEX}
+        self.tokens = []         # [TOKENS, ...]
+        self.counts = {ref: array('i') for ref in self.ref_names}  # Occurrences in each reference stats set
+        self.prices = array('d')  # NaN when the price is unknown
+        self.num_ref_cubes = {ref: 0 for ref in self.ref_names}  # E.g. {'Legacy': 10} (from "OCCURRENCES/10")
+
+        # Membership bitsets
+        self.cube_bits = {name: 0 for name in self.cube_names}  # Cards in each of my cubes
+        self.ref_bits = {ref: 0 for ref in self.ref_names}      # Cards in each reference stats set
+        self.group_ref_bits = {}  # {GROUP_NAME: {REF_NAME: BITS}} Cards in each group's CSV of each stats set
+        self.group_order = {}     # {GROUP_NAME: array of CARD_INDEX} Group's cards in order of first appearance
+
+    def _card(self, name):
+        """Returns the index of the card, adding a new card to every column if needed."""
+        if name in self._card_index:
+            return self._card_index[name]
+        i = len(self.card_names)
+        self._card_index[name] = i
+        self.card_names.append(name)
+        self.tokens.append('')
+        for ref in self.ref_names:
+            self.counts[ref].append(0)
+        self.prices.append(math.nan)
+        return i
+
+    def update_group_list(self, group_name, ref_name, csv_path):
+        group_bits = self.group_ref_bits.setdefault(group_name, {ref: 0 for ref in self.ref_names})
+        order = self.group_order.setdefault(group_name, array('i'))
         with open(csv_path) as csvfile:
             reader = csv.reader(csvfile)
-            for i, row in enumerate(reader):
-                if i == 0:
-                    headers = row
-                    for k, head in enumerate(headers):
-                        if 'OCCURRENCES/' in head:
-                            occur_index = k
-                            break
-                    continue
-                name = row[headers.index('NAME')]
-                occur_col = row[occur_index]
-                count = int(occur_col.split('/')[0])
-                tokens = row[headers.index('TOKENS')]
-
-                if name in possible_cards:
-                    possible_cards[name].total_occur += count
-                    possible_cards[name].occur_per_cube[cube_name] = occur_col
-                else:
-                    possible_cards[name] = PossibleCard(name, {cube_name: occur_col}, count, tokens)
-        self.group_lists[group_name] = possible_cards
+            headers = next(reader)
+            occur_index = [k for k, head in enumerate(headers) if 'OCCURRENCES/' in head][0]
+            name_index = headers.index('NAME')
+            tokens_index = headers.index('TOKENS')
+            self.num_ref_cubes[ref_name] = max(
+                self.num_ref_cubes[ref_name], int(headers[occur_index].split('/')[1]))
+            for row in reader:
+                i = self._card(row[name_index])
+                bit = 1 << i
+                if not any(bits & bit for bits in group_bits.values()):
+                    order.append(i)
+                    self.tokens[i] = row[tokens_index]
+                group_bits[ref_name] |= bit
+                self.ref_bits[ref_name] |= bit
+                self.counts[ref_name][i] = int(row[occur_index].split('/')[0])
 
     def load_files(self):
-        for cube_name in self.config['cubes']:
+        for cube_name in self.cube_names:
             self.my_cube_lists[cube_name] = []
             card_list = self.config['cubes'][cube_name]['my_card_list']
             with open(card_list) as csvfile:
@@ -66,63 +113,149 @@ class Comparer(object):
                         continue
                     incard = IncludedCard(row[0], row[1], row[2:] if len(row) > 2 else None)
                     self.my_cube_lists[cube_name].append(incard)
-        
-        for cube_name in self.config['cubes']:
-            stats_dir = self.config['cubes'][cube_name]['stats_csvs']
-            for csvfile in [f for f in os.listdir(stats_dir) if not f.startswith('.')]:
+                    self.cube_bits[cube_name] |= 1 << self._card(incard.name)
+
+        for ref_name, stats_dir in self.reference_dirs.items():
+            for csvfile in sorted([f for f in os.listdir(stats_dir) if not f.startswith('.')]):
                 group_name = csvfile.rsplit('.', 1)[0]
-                self.update_group_list(group_name, cube_name, os.path.join(stats_dir, csvfile))
-
-    def get_include_marks(self, card_name):
-        include_marks = []
-        # Iteratre thru all my cube lists (e.g. Legacy, Vinetage)
-        for mcl in self.my_cube_lists.values():
-            is_included_in_mcl = False
-            for incard in mcl:
-                if card_name == incard.name:
-                    is_included_in_mcl = True
-                    break
-            include_marks.append('X' if is_included_in_mcl else '')
-        return include_marks
+                self.update_group_list(group_name, ref_name, os.path.join(stats_dir, csvfile))
+
+        self.price_cache = read_price_cache(self.config['price_cache_path'])
+        for name, i in self._card_index.items():
+            price = self.price_cache.get(name, {}).get('price')
+            if isinstance(price, (int, float)):
+                self.prices[i] = price
+
+    def get_include_marks(self, card_index):
+        bit = 1 << card_index
+        return ['X' if self.cube_bits[name] & bit else '' for name in self.cube_names]
+
+    def weighted_occurrences(self):
+        """Returns an array of each card's occurrence rate, summed over the reference stats sets.
+
+        E.g. a card in 3/10 of one set's cubes and 5/20 of another's has a weighted occurrence of 0.55
+        """
+        weights = array('d', [0.0]) * len(self.card_names)
+        for ref in self.ref_names:
+            if self.num_ref_cubes[ref]:
+                counts = self.counts[ref]
+                num_cubes = self.num_ref_cubes[ref]
+                for i in _bits_to_indexes(self.ref_bits[ref]):
+                    weights[i] += counts[i] / num_cubes
+        return weights
 
     def generate_tables(self):
         all_group_tables = {}  # {group_name: table_rows}
-        price_cache = read_price_cache(self.config['price_cache_path'])
         header = ['NAME', 'PRICE', 'TOTAL_COUNT'] + \
-            ['{} Count'.format(name) for name in list(self.config['cubes'].keys())] + \
-            ['Have in {}?'.format(name) for name in list(self.config['cubes'].keys())] + ['TOKENS']
+            ['{} Count'.format(name) for name in self.ref_names] + \
+            ['Have in {}?'.format(name) for name in self.cube_names] + ['TOKENS']
+        my_groups = {}  # {GROUP_NAME: [CARD_INDEX, ...]} Cards I chose for each group, in cube order
+        for cube_name in self.cube_names:
+            for incard in self.my_cube_lists[cube_name]:
+                my_groups.setdefault(incard.group, []).append(self._card_index[incard.name])
 
-        for group_name in self.group_lists:
-            all_possibles = list(self.group_lists[group_name].values())
-            all_possibles.sort(key=lambda card: card.total_occur, reverse=True)  # Sort by highest card count
+        for group_name, order in self.group_order.items():
+            group_bits = self.group_ref_bits[group_name]
+            in_group_csvs = 0
+            for bits in group_bits.values():
+                in_group_csvs |= bits
+            totals = dict.fromkeys(order, 0)
+            occurrences = {i: [''] * len(self.ref_names) for i in order}
+            for r, ref in enumerate(self.ref_names):
+                counts = self.counts[ref]
+                for i in _bits_to_indexes(group_bits[ref]):
+                    totals[i] += counts[i]
+                    occurrences[i][r] = '{}/{}'.format(counts[i], self.num_ref_cubes[ref])
+            # Sort by highest card count
+            ranked = sorted(order, key=lambda i: totals[i], reverse=True)
 
             table = [header]
-            # Go thru all PossibleCard's within the group
-            for pcard in all_possibles:
-                price = price_cache.get(pcard.name, {'price': 'MISSING'})['price']
-                table.append([pcard.name, price, pcard.total_occur]
-                    + pcard.get_occurences(self.my_cube_lists.keys()) + self.get_include_marks(pcard.name)
-                    + [pcard.tokens])
-
-            # Now, iterate thru all my cube lists (e.g. Legacy, Vinetage), looking for cards NOT in 
-            # the PossibleCard's (which were collected from stats_csvs)
-            my_choice_cards = []  # Cards that I chose that didn't appear in most popular cubetutor.com cubes
-            for mcl in self.my_cube_lists.values():
-                 for incard in mcl:
-                     if incard.group == group_name and incard.name not in my_choice_cards + all_possibles:
-                         my_choice_cards.append(incard.name)
-            # Mark which cubes contain my choice cards
-            for card_name in my_choice_cards:
-                card_data = price_cache.get(card_name)
+            for i in ranked:
+                name = self.card_names[i]
+                price = self.price_cache.get(name, {'price': 'MISSING'})['price']
+                table.append([name, price, totals[i]] + occurrences[i] + self.get_include_marks(i) + [self.tokens[i]])
+
+            # Now, add the cards from my cube lists (e.g. Legacy, Vinetage) that are NOT in the group's stats
+            # CSVs. I.e. cards that I chose that didn't appear in most popular cubetutor.com cubes
+            added = 0
+            for i in my_groups.get(group_name, []):
+                bit = 1 << i
+                if (in_group_csvs | added) & bit:
+                    continue
+                added |= bit
+                card_data = self.price_cache.get(self.card_names[i])
                 if card_data is None or card_data['price'] is None:
                     price = '<Missing>'
                 else:
                     price = card_data['price']
-                table.append([card_name, price, '', '', ''] + self.get_include_marks(card_name))            
+                table.append([self.card_names[i], price] + [''] * (1 + len(self.ref_names)) +
+                             self.get_include_marks(i))
             all_group_tables[group_name] = table
 
         return all_group_tables
 
+    def generate_summaries(self, top_n=DEFAULT_SUMMARY_TOP_N):
+        """Returns {SUMMARY_NAME: table_rows} with:
+
+        overlap            For each of my cubes x reference stats set: how many cards they share, the percentage
+                           of each that the other contains, and the percentage of the set's weighted occurrences
+                           that my cube covers
+        costs              For each of my cubes: its total price, the price of its top_n most missing cards, and
+                           the price of the cards it has that each of my other cubes does not
+        missing_<CUBE>     For each of my cubes: the top_n cards it doesn't have, by weighted occurrence
+        """
+        weights = self.weighted_occurrences()
+        summaries = {}
+
+        overlap = [['MY_CUBE', 'REFERENCE', 'MY_CARDS', 'REFERENCE_CARDS', 'SHARED_CARDS',
+                    '% OF MY CUBE IN REFERENCE', '% OF REFERENCE IN MY CUBE', '% OF WEIGHTED OCCURRENCES']]
+        for cube_name in self.cube_names:
+            for ref in self.ref_names:
+                shared = self.cube_bits[cube_name] & self.ref_bits[ref]
+                my_size = _popcount(self.cube_bits[cube_name])
+                ref_size = _popcount(self.ref_bits[ref])
+                ref_weight = sum(self.counts[ref][i] for i in _bits_to_indexes(self.ref_bits[ref]))
+                shared_weight = sum(self.counts[ref][i] for i in _bits_to_indexes(shared))
+                overlap.append([cube_name, ref, my_size, ref_size, _popcount(shared),
+                                _percent(_popcount(shared), my_size), _percent(_popcount(shared), ref_size),
+                                _percent(shared_weight, ref_weight)])
+        summaries['overlap'] = overlap
+
+        costs = [['MY_CUBE', 'TOTAL_PRICE', 'CARDS_MISSING_A_PRICE', 'PRICE_OF_TOP_{}_MISSING'.format(top_n)] +
+                 ['PRICE_OF_CARDS_NOT_IN_{}'.format(other) for other in self.cube_names]]
+        for cube_name in self.cube_names:
+            bits = self.cube_bits[cube_name]
+            missing = sorted(_bits_to_indexes(self._all_ref_bits() & ~bits),
+                             key=lambda i: weights[i], reverse=True)[:top_n]
+            summaries['missing_' + cube_name] = [['NAME', 'WEIGHTED_OCCURRENCE', 'PRICE'] +
+                                                 ['{} Count'.format(ref) for ref in self.ref_names]] + [
+                [self.card_names[i], round(weights[i], 3), _price_str(self.prices[i])] +
+                ['{}/{}'.format(self.counts[ref][i], self.num_ref_cubes[ref]) for ref in self.ref_names]
+                for i in missing]
+            costs.append([cube_name, _price_str(self._total_price(bits)),
+                          sum(1 for i in _bits_to_indexes(bits) if math.isnan(self.prices[i])),
+                          _price_str(self._total_price(sum(1 << i for i in missing)))] +
+                         [_price_str(self._total_price(bits & ~self.cube_bits[other])) for other in self.cube_names])
+        summaries['costs'] = costs
+        return summaries
+
+    def _all_ref_bits(self):
+        bits = 0
+        for ref_bits in self.ref_bits.values():
+            bits |= ref_bits
+        return bits
+
+    def _total_price(self, bits):
+        return math.fsum(self.prices[i] for i in _bits_to_indexes(bits) if not math.isnan(self.prices[i]))
+
+
+def _percent(numerator, denominator):
+    return '{:.1f}%'.format(100.0 * numerator / denominator) if denominator else ''
+
+
+def _price_str(price):
+    return '' if math.isnan(price) else '${:,.2f}'.format(price)
+
 
 def write_csv(group_name, table, output_dir):
     try:
@@ -142,8 +275,16 @@ def pretty_print_table(group_name, table):
     print(tt.draw())
 
 
-def main():
-    with open('inputs/compare_legacy_vs_vinetage.yaml', 'r') as fh:
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compares my cube lists with the stats generated by cube_stats.py')
+    parser.add_argument(
+        '-c', '--config_path', default='inputs/compare_legacy_vs_vinetage.yaml',
+        help='Path to the configuration file')
+    return parser.parse_args()
+
+
+def main(args):
+    with open(args.config_path, 'r') as fh:
         config = yaml.load(fh.read())
     c = Comparer(config)
     c.load_files()
@@ -151,7 +292,10 @@ def main():
     for group_name, table in tables.items():
         write_csv(group_name, table, config['output_dir'])
         # pretty_print_table(group_name, table)
+    summaries = c.generate_summaries(config.get('summary_top_n', DEFAULT_SUMMARY_TOP_N))
+    for summary_name, table in summaries.items():
+        write_csv(summary_name, table, os.path.join(config['output_dir'], SUMMARY_DIR))
 
 
 if __name__ == '__main__':
-    main()
+    main(parse_args())
@@ -7,8 +7,10 @@ Date:          2018-07-15
 import aggregator
 import argparse
 import common
+import exporter
 import groupings
 import logging
+import snapshots
 import yaml
 PROGRAM_PURPOSE = """Generates statistics on a proposed MTG Cube based on other popular cubes on cubetutor.com"""
 
@@ -24,6 +26,12 @@ def parse_args():
         '-u', '--update_throttled_entries', action='store_true', help='By default, cached prices are not updated '
         'unless they are outdated. Using this flag will update any cached prices that have an non-empty entry for '
         'the "skipped_due_to_throttle" field in the cache, even if the price is not outdated.')
+    parser.add_argument(
+        '-a', '--as_of', type=snapshots.date_arg, help='Aggregate the cubetutor lists as they were on this date '
+        '(YYYY-MM-DD), using the snapshots recorded by earlier runs. Prices are still the current prices.')
+    parser.add_argument(
+        '-f', '--force', action='store_true', help='Recompute every stage, even those whose inputs are unchanged '
+        'since the last run.')
     return parser.parse_args()
 
 
@@ -43,7 +51,7 @@ def main(args):
     with open(args.config_path, 'r') as fh:
         config = yaml.load(fh.read())
 
-    ag = aggregator.Aggregator(config, args.skip_downloads, args.update_throttled_entries)
+    ag = aggregator.Aggregator(config, args.skip_downloads, args.update_throttled_entries, args.as_of, args.force)
     '''
     print('\n***************')
     print('* Card Counts *')
@@ -57,7 +65,10 @@ def main(args):
     print('*************')
     '''
     all_groupings = groupings.create_groupings(ag.grouping_specs, ag.num_other_cubes)
-    groupings.GroupingProcessor(ag.cards, config['output_dir'], all_groupings, True)
+    groupings.GroupingProcessor(ag.cards, config['output_dir'], all_groupings, True, ag.stage_cache, ag.cards_key)
+    if 'export' in config:
+        exporter.export(config['export'], ag, all_groupings, ag.stage_cache)
+    ag.stage_cache.save()
 
 
 if __name__ == '__main__':
@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import asyncio
 import common
+import http.cookiejar
 import logging
 import os
 import requests
 import time
-import urllib
 import yaml
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 try:
     import web_source_classes
@@ -16,10 +18,62 @@ except ImportError:
         '"cube_stats.py" will only work when using theh "-s" flag')
 
 
+CUBETUTOR_URL = 'https://www.cubetutor.com'
+EXPORT_FORM_START = b'/viewcube.exportform.exportlistform'
+FORMDATA_MARKER = b'name="t:ac" type="hidden"></input><input value="'
+MAX_FORMDATA_SCAN_BYTES = 4 * 1024 * 1024  # Give up looking for t:formdata after this much of the cube's page
+SCAN_CHUNK_BYTES = 16 * 1024
+CONCURRENT_DOWNLOADS = 8
+DOWNLOAD_ATTEMPTS = 3
+REQUEST_TIMEOUT_SECONDS = 60
+
+
+class TransientDownloadError(Exception):
+    pass
+
+
+def find_formdata(chunks, max_bytes=MAX_FORMDATA_SCAN_BYTES):
+    """Incrementally scans the chunks of a cube's page for the value of the export form's t:formdata.
+
+    Only a small tail of the page is kept between chunks, and the scan stops as soon as the value is found
+    (or after max_bytes).
+
+    Returns:
+        The t:formdata value, or None if it was not found
+    """
+    buf = b''
+    scanned = 0
+    found_form = False
+    for chunk in chunks:
+        scanned += len(chunk)
+        buf += chunk
+        if not found_form:
+            i = buf.find(EXPORT_FORM_START)
+            if i < 0:
+                buf = buf[-len(EXPORT_FORM_START):]
+            else:
+                found_form = True
+                buf = buf[i + len(EXPORT_FORM_START):]
+        if found_form:
+            i = buf.find(FORMDATA_MARKER)
+            if i < 0:
+                buf = buf[-len(FORMDATA_MARKER):]
+            else:
+                buf = buf[i:]  # Keep the start of the value until its closing quote arrives
+                end = buf.find(b'"', len(FORMDATA_MARKER))
+                if end >= 0:
+                    return buf[len(FORMDATA_MARKER):end].decode('utf-8')
+        if scanned > max_bytes:
+            break
+    return None
+
+
 class CubeTutorDownloader(object):
 
-    def __init__(self, cache_dir):
+    def __init__(self, cache_dir, concurrency=CONCURRENT_DOWNLOADS, attempts=DOWNLOAD_ATTEMPTS):
         self.cache_dir = cache_dir
+        self._concurrency = concurrency
+        self._attempts = attempts
 
     @staticmethod
     def get_cube_file_path(cache_dir, cude_id):
@@ -31,29 +85,82 @@ class CubeTutorDownloader(object):
         except OSError:
             pass
         cube_paths = []
+        stale_ids = []
         for cid in cube_ids:
             fpath = self.get_cube_file_path(self.cache_dir, cid)
             if self._should_refresh_list(fpath):
-                self._download_cubetutor_list(cid, cube_ids[cid])
+                stale_ids.append(cid)
             cube_paths.append(fpath)
+        if stale_ids:
+            asyncio.run(self._download_cubetutor_lists({cid: cube_ids[cid] for cid in stale_ids}))
+        # A cube whose download failed still has its previously cached list, unless it was never downloaded
+        missing = [fpath for fpath in cube_paths if not os.path.exists(fpath)]
+        if missing:
+            raise RuntimeError('Could not download these cubetutor lists, which are Not cached locally '
+                               'either: {}'.format(', '.join(missing)))
         return cube_paths
 
-    def _download_cubetutor_list(self, cube_id, cube_name):
-        url = 'https://www.cubetutor.com/viewcube/{}'.format(cube_id)
+    async def _download_cubetutor_lists(self, cube_ids):
+        """Runs the handshakes of all of the cubes concurrently, sharing one HTTP session (& connection pool).
+
+        requests is blocking, so each handshake runs in a worker thread; asyncio bounds the concurrency and
+        schedules the retries. The session never stores cookies, since every handshake needs its own JSESSIONID.
+        """
+        semaphore = asyncio.Semaphore(self._concurrency)
+        with requests.Session() as session, ThreadPoolExecutor(self._concurrency) as executor:
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            await asyncio.gather(*[self._download_with_retries(session, executor, semaphore, cid, name)
+                                   for cid, name in cube_ids.items()])
+
+    async def _download_with_retries(self, session, executor, semaphore, cube_id, cube_name):
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, self._attempts + 1):
+            async with semaphore:
+                start = time.time()
+                try:
+                    downloaded = await loop.run_in_executor(
+                        executor, self._download_cubetutor_list, session, cube_id, cube_name)
+                    if downloaded:
+                        logging.info('Downloaded cube {} ({}) in {:.2f}s'.format(
+                            cube_id, cube_name, time.time() - start))
+                    else:
+                        logging.error('Failed to download cube {} ({}) after {:.2f}s'.format(
+                            cube_id, cube_name, time.time() - start))
+                    return
+                except (requests.exceptions.RequestException, TransientDownloadError) as e:
+                    logging.warning('Attempt {}/{} to download cube {} failed after {:.2f}s: {}'.format(
+                        attempt, self._attempts, cube_id, time.time() - start, e))
+            if attempt < self._attempts:
+                await asyncio.sleep(2 ** attempt)
+        logging.error('Giving up on downloading cube {} ({})'.format(cube_id, cube_name))
+
+    def _check_status(self, resp, url):
+        if resp.status_code == 429 or resp.status_code >= 500:
+            raise TransientDownloadError('Got status code {} for request to {}'.format(resp.status_code, url))
+        if resp.status_code != 200:
+            logging.warn('Got status code {} for request to {}'.format(resp.status_code, url))
+            return False
+        return True
+
+    def _download_cubetutor_list(self, session, cube_id, cube_name):
+        """Downloads a cube's list to its cache file.
+
+        Returns:
+            Whether the list was downloaded. Raises TransientDownloadError for failures worth retrying.
+        """
+        url = '{}/viewcube/{}'.format(CUBETUTOR_URL, cube_id)
         logging.debug('Requesting {}'.format(url))
-        r = requests.get(url)
-        if r.status_code != 200:
-            logging.warn('Got status code {} for request to {}'.format(r.status_code, url))
-            return
-        for k, v in r.cookies.items():
-            if k == 'JSESSIONID':
-                jess_id = v
-        # Get t:formdata
-        t_formdata = r.text.split('/viewcube.exportform.exportlistform', 1)[1].split(
-            'name="t:ac" type="hidden"></input><input value="', 1)[1].split('"', 1)[0]
+        cookies = requests.cookies.RequestsCookieJar()  # This handshake's JSESSIONID
+        with session.get(url, cookies=cookies, stream=True, timeout=REQUEST_TIMEOUT_SECONDS) as r:
+            if not self._check_status(r, url):
+                return False
+            t_formdata = find_formdata(r.iter_content(SCAN_CHUNK_BYTES))
+            cookies.update(r.cookies)
+        if t_formdata is None:
+            raise TransientDownloadError('Could not find t:formdata for cube {}'.format(cube_id))
         logging.debug('t_formdata for cube {} = {}'.format(cube_id, t_formdata))
 
-        url = 'https://www.cubetutor.com/viewcube.exportform.exportlistform?t:ac=' + str(cube_id)
+        url = '{}/viewcube.exportform.exportlistform?t:ac={}'.format(CUBETUTOR_URL, cube_id)
         post_data={
             't:ac': cube_id,
             't:formdata': t_formdata,
@@ -61,12 +168,12 @@ class CubeTutorDownloader(object):
             'submit_0': 'Export',
             't:submit': '["submit_2","submit_0"]',
         }
-        r = requests.post(url, cookies=r.cookies, data=post_data)
-        print('\ncurl -d "{}" --cookie "JSESSIONID={}" "{}"\n'.format(
-            urllib.parse.urlencode(post_data), jess_id, url))
-
-        with open(self.get_cube_file_path(self.cache_dir, cube_id), 'w') as fh:
-            fh.write('# {}\n\n{}'.format(cube_name, r.text))  # .encode('utf-8')))  [py2.7 only]
+        # The cookies (JSESSIONID) are passed explicitly since the shared session does not store them
+        r = session.post(url, cookies=cookies, data=post_data, timeout=REQUEST_TIMEOUT_SECONDS)
+        if not self._check_status(r, url):
+            return False
+        common.atomic_write(self.get_cube_file_path(self.cache_dir, cube_id), '# {}\n\n{}'.format(cube_name, r.text))
+        return True
 
     def _should_refresh_list(self, cube_path):
         try:
@@ -76,11 +183,30 @@ class CubeTutorDownloader(object):
 
         one_month = 3600 * 24 * 30
         if time.time() - modified > one_month:
-            os.remove(cube_path)
             return True
         return False
 
 
+def is_cached_price_current(cache_entry, max_cached_days, update_throttled=False):
+    """Returns whether a price cache entry can be used instead of querying the web sources again."""
+    if cache_entry is None:
+        return False
+    data_age = (datetime.now() - datetime.strptime(cache_entry['date'], '%Y-%m-%d')).days
+    return (
+        data_age <= max_cached_days and
+        'web_source' in cache_entry and
+        cache_entry['web_source'].lower() != 'mtgprice' and  # mtgprice is unreliable
+        cache_entry['price'] is not None and
+        cache_entry['price'] != 0
+        and (
+            # Use the price cache if:
+            #     (1) we are Not updating throttled entries, OR (2) the card entry was NOT throttled
+            not update_throttled or  # update_throttled=True
+            not cache_entry.get('skipped_due_to_throttle', True)
+        )
+    )
+
+
 class FailLog(object):
 
     def __init__(self):
@@ -116,9 +242,10 @@ class FailLog(object):
 
 class PriceFetcher(object):
 
-    def __init__(self, cache_file_path, max_cached_days, all_sets_json):
+    def __init__(self, cache_file_path, max_cached_days, all_sets_json, name_index=None):
         self._cache_file_path = cache_file_path
         self._max_cached_days = max_cached_days
+        self._name_index = name_index  # CardNameIndex used to find the web sources' names for cards
         self._fail_log = FailLog()
         # self.price_cache = {<CARD_NAME>: {'date': <>, 'price': <>}}
         # E.g. {Abrade: {date: '2018-01-23', price: 1.34}}
@@ -130,21 +257,7 @@ class PriceFetcher(object):
 
         # First, check if the card price is in local cache and is not stale
         if card_name in self.price_cache:
-            cached_date = datetime.strptime(self.price_cache[card_name]['date'], '%Y-%m-%d')
-            data_age = (datetime.now() - cached_date).days
-            if (
-                data_age <= self._max_cached_days and
-                'web_source' in self.price_cache[card_name] and
-                self.price_cache[card_name]['web_source'].lower() != 'mtgprice' and  # mtgprice is unreliable
-                self.price_cache[card_name]['price'] is not None and
-                self.price_cache[card_name]['price'] != 0
-                and (
-                    # Use the price cache if:
-                    #     (1) we are Not updating throttled entries, OR (2) the card entry was NOT throttled
-                    not update_throttled or  # update_throttled=True
-                    not self.price_cache[card_name].get('skipped_due_to_throttle', True)
-                )
-            ):
+            if is_cached_price_current(self.price_cache[card_name], self._max_cached_days, update_throttled):
                 return self.price_cache[card_name]['price']
 
             if 'web_source' in self.price_cache[card_name]:
@@ -152,15 +265,16 @@ class PriceFetcher(object):
             else:
                 logging.debug('\n\t {} | No web source'.format(card_name))
 
-        if all([card_name not in ws.setname_map for ws in self.web_sources]):
+        lookup_name = self._lookup_name(card_name)
+        if all([lookup_name not in ws.setname_map for ws in self.web_sources]):
             return "NAME_NOT_FOUND"
 
         lowest_price = None
         skipped_due_to_throttle = set()
         missing_card_price = set()
         for web_source in self.web_sources:
-            for set_name in web_source.setname_map[card_name]:
-                resp = web_source.make_http_request(card_name, set_name)
+            for set_name in web_source.setname_map.get(lookup_name, []):
+                resp = web_source.make_http_request(lookup_name, set_name)
                 if resp is None:
                     self._fail_log.add(set_name, web_source.name, web_source.last_response)
                     if web_source.is_throttled:
@@ -168,7 +282,7 @@ class PriceFetcher(object):
                     else:
                         missing_card_price.add(web_source.name)
                     continue
-                price = web_source.parse_url_response(resp)
+                price = resp.price if resp.price is not None else web_source.parse_url_response(resp)
                 if price != 0 and (lowest_price is None or price < lowest_price):
                     lowest_price = price
             if lowest_price is not None:
@@ -182,12 +296,23 @@ class PriceFetcher(object):
         }
         return lowest_price
 
+    def _lookup_name(self, card_name):
+        return (self._name_index.resolve(card_name) if self._name_index else None) or card_name
+
+    def unpriceable_names(self, card_names):
+        """Returns the card names that no web source lists (so query_price() does not cache a price for them)."""
+        return {name for name in card_names
+                if all([self._lookup_name(name) not in ws.setname_map for ws in self.web_sources])}
+
     def bulk_query_price(self, list_card_objs, update_throttled=False):
         list_card_objs.sort(key=lambda card: card.name)  # Sort by card name
         try:
             for card in list_card_objs:
                 card.price = self.query_price(card.name, update_throttled)
         finally:
-            # Saves card prices to the local cache file
-            common.save_to_price_cache(self.price_cache, self._cache_file_path)
-            self._fail_log.save(os.path.dirname(self._cache_file_path))
+            self.save()
+
+    def save(self, backup=True):
+        # Saves card prices to the local cache file
+        common.save_to_price_cache(self.price_cache, self._cache_file_path, backup)
+        self._fail_log.save(os.path.dirname(self._cache_file_path))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Exports the aggregated card statistics for ad-hoc querying with SQL (SQLite) or dataframes (Parquet)
+
+Tables (the Parquet files have the same names and columns):
+    cards           One row per aggregated card (including its occurrences & price)
+    cubes           One row per cubetutor cube
+    cube_cards      Which cards are in which cubes (cube_id, card_name, count)
+    grouping_cards  Which cards are in which groupings, in output order (grouping, position, card_name)
+
+Rows are generated lazily and written in batches, so memory use does not grow with the size of the corpus.
+"""
+import json
+import logging
+import os
+import sqlite3
+from contextlib import closing
+from itertools import islice
+from common import OCCUR_STR
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+BATCH_SIZE = 10000
+
+CARD_COLUMNS = [
+    # (COLUMN_NAME, SQLITE_TYPE, Card.json KEY)
+    ('name', 'TEXT PRIMARY KEY', None),
+    ('occurrences', 'INTEGER', OCCUR_STR),
+    ('price', 'REAL', 'price_raw'),
+    ('converted_mana_cost', 'REAL', 'convertedManaCost'),
+    ('mana_cost', 'TEXT', 'manaCost'),
+    ('type', 'TEXT', 'type'),
+    ('colors', 'TEXT', 'colors'),
+    ('color_identity', 'TEXT', 'colorIdentity'),
+    ('power', 'TEXT', 'power'),
+    ('toughness', 'TEXT', 'toughness'),
+    ('tokens', 'TEXT', 'tokens'),
+    ('text', 'TEXT', 'text'),
+    ('sets', 'TEXT', None),
+    ('json', 'TEXT', None),
+]
+TABLES = {
+    'cards': [(name, sql_type) for name, sql_type, _ in CARD_COLUMNS],
+    'cubes': [('cube_id', 'TEXT PRIMARY KEY'), ('name', 'TEXT')],
+    'cube_cards': [('cube_id', 'TEXT'), ('card_name', 'TEXT'), ('count', 'INTEGER')],
+    'grouping_cards': [('grouping', 'TEXT'), ('position', 'INTEGER'), ('card_name', 'TEXT')],
+}
+INDEXES = [
+    ('cube_cards', 'card_name'), ('cube_cards', 'cube_id'),
+    ('grouping_cards', 'grouping'), ('grouping_cards', 'card_name'),
+    ('cards', 'occurrences'), ('cards', 'price'),
+]
+
+
+def _card_row(card):
+    row = []
+    for column, _, json_key in CARD_COLUMNS:
+        if column == 'name':
+            row.append(card.name)
+        elif column == 'sets':
+            row.append(','.join(card.sets or []))
+        elif column == 'json':
+            row.append(json.dumps(card.json, sort_keys=True, default=str))
+        else:
+            value = card.json.get(json_key)
+            row.append(','.join(value) if type(value) == list else value)
+    return row
+
+
+def iter_table_rows(ag, groupings):
+    """Returns {TABLE_NAME: ROW_GENERATOR} for the Aggregator's cards and the processed groupings."""
+    return {
+        'cards': (_card_row(card) for card in ag.cards.values()),
+        'cubes': ([str(cid), name] for cid, name in ag.cube_names.items()),
+        'cube_cards': ([str(cid), card_name, count] for cid, card_name, count in ag.iter_cube_memberships()),
+        'grouping_cards': ([group.name, i + 1, card.name]
+                           for group in groupings for i, card in enumerate(group.cards)),
+    }
+
+
+def _batches(rows):
+    while True:
+        batch = list(islice(rows, BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+
+def export_sqlite(db_path, ag, groupings, export_key=None):
+    """Writes every table to a SQLite database, replacing the database only once it is complete.
+
+    Skipped if the existing database was exported with the same export_key (i.e. from the same inputs).
+    """
+    if export_key is not None and os.path.exists(db_path):
+        with closing(sqlite3.connect(db_path)) as conn:
+            try:
+                existing_key = conn.execute('SELECT value FROM meta WHERE key = ?', ('export_key',)).fetchone()
+            except sqlite3.DatabaseError:
+                existing_key = None
+        if existing_key == (export_key,):
+            return
+
+    os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+    tmp_path = '{}.tmp{}'.format(db_path, os.getpid())
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('INSERT INTO meta VALUES (?, ?)', ('export_key', export_key))
+        for table, rows in iter_table_rows(ag, groupings).items():
+            columns = TABLES[table]
+            conn.execute('CREATE TABLE {} ({})'.format(
+                table, ', '.join('{} {}'.format(name, sql_type) for name, sql_type in columns)))
+            conn.executemany('INSERT INTO {} VALUES ({})'.format(table, ', '.join('?' * len(columns))), rows)
+        # Indexes are faster to build once all of the rows are inserted
+        for table, column in INDEXES:
+            conn.execute('CREATE INDEX {0}_{1} ON {0} ({1})'.format(table, column))
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, db_path)
+
+
+def export_parquet(output_dir, ag, groupings):
+    """Writes every table to <output_dir>/<table>.parquet (requires pyarrow)."""
+    if pyarrow is None:
+        logging.error('Cannot export Parquet files because "pyarrow" is not installed')
+        return
+    arrow_types = {'TEXT': pyarrow.string(), 'INTEGER': pyarrow.int64(), 'REAL': pyarrow.float64()}
+    os.makedirs(output_dir, exist_ok=True)
+    for table, rows in iter_table_rows(ag, groupings).items():
+        schema = pyarrow.schema([(name, arrow_types[sql_type.split()[0]]) for name, sql_type in TABLES[table]])
+        with pyarrow.parquet.ParquetWriter(os.path.join(output_dir, table + '.parquet'), schema) as writer:
+            for batch in _batches(rows):
+                columns = list(zip(*batch))
+                writer.write_batch(pyarrow.RecordBatch.from_arrays(
+                    [pyarrow.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema))
+
+
+def export(export_config, ag, groupings, stage_cache=None):
+    """Runs the exports specified by the "export" section of a config file, e.g.
+
+    export:
+      sqlite_path: outputs/legacy_stats.sqlite
+      parquet_dir: outputs/legacy_parquet
+    """
+    if 'sqlite_path' in export_config:
+        export_key = None
+        if stage_cache is not None and ag.cards_key is not None:
+            export_key = stage_cache.key('export', ag.cards_key, [group.spec for group in groupings])
+        export_sqlite(export_config['sqlite_path'], ag, groupings, export_key)
+    if 'parquet_dir' in export_config:
+        export_parquet(export_config['parquet_dir'], ag, groupings)
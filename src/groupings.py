@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import csv
-import logging
+import io
 import os
 import texttable
+from card_attributes import BITSET_FIELDS
+from card_attributes import get_derived
+from card_attributes import matches_custom_filter
+from card_attributes import symbols_to_bits
 from common import OCCUR_STR
+from concurrent.futures import ThreadPoolExecutor
+WRITER_THREADS = 8
 
 class Grouping(object):
     """Takes in specifications for a desired grouping of cards.
@@ -29,29 +35,40 @@ class Grouping(object):
         # Columns: ('name', 'manaCost', ('power', '/', 'toughness'), 'notes')
         self.columns = columns
         self.force_include = force_include  # Grouping must include these card names
+        self._compiled_filters = compile_filters(filters)
+        self._header_row, self._format_row = compile_columns(columns)
         # List of cards in the group
         self._cards = []
         self._sorted = True
 
+    @property
+    def spec(self):
+        """Everything that determines which cards are in the grouping and their order."""
+        return [self.name, self.filters, self.sorts, self.force_include]
+
+    @property
+    def cards(self):
+        return self._cards
+
+    def set_sorted_cards(self, cards):
+        self._cards = list(cards)
+        self._sorted = True
+
     def add_unconditionally(self, card):
         self._sorted = False
         self._cards.append(card)
 
     def matches_custom_filter(self, card, custom_filter, include):
-        if custom_filter == '3+_colors':
-            return len(card.json['colors']) >= 3 if include else len(card.json['colors']) < 3
-        else:
-            logging.error('Unrecognized custom filer: {}'.format(custom_filter))
+        """Custom filters are registered in card_attributes.py"""
+        result = matches_custom_filter(card, custom_filter)
+        if result is None:
             return False
+        return result if include else not result
 
     def add_if_qualifies(self, card):
         """Adds a card to the grouping if it matches the filters."""
         matches = True
-        for key, value in self.filters.items():
-            include = not key.startswith('not_')
-            if not include:
-                key = key[4:]  # Remove "not_"
-
+        for key, value, include, bitset in self._compiled_filters:
             if key == 'custom':
                 matches = self.matches_custom_filter(card, value, include)
                 break
@@ -67,9 +84,15 @@ class Grouping(object):
                         break
             
             if value is None:  # None means the field should not exist
-                if card.json.has_key(key):
+                if key in card.json:
                     matches = False
                     break                    
+            elif bitset is not None:  # Same as the list check below, using the card's precomputed bitset
+                attribute, mask = bitset
+                card_bits = get_derived(card)[attribute]
+                if (include and card_bits & mask != mask) or (not include and card_bits & mask):
+                    matches = False
+                    break
             elif type(value) == list:
                 if include:  # E.g. No Match: Check red creature for colors=['R', 'G']
                     if any([target_attrib not in card.json.get(key, []) for target_attrib in value]):
@@ -103,10 +126,7 @@ class Grouping(object):
                     attribute = attribute[8:]
                 if attribute == 'convertedManaCost':
                     # I want to count each X as 100 in the calculation of the convertedManaCost
-                    if '{X}' in card.json.get('manaCost', ''):
-                        val = 100 * card.json['manaCost'].count('{X}') + int(card.json['convertedManaCost'])
-                    else:
-                        val = int(card.json['convertedManaCost'])
+                    val = get_derived(card)['adjusted_cmc']
                 elif is_int(card.json.get(attribute)):
                     val = int(card.json[attribute])
                 else:
@@ -119,66 +139,118 @@ class Grouping(object):
         self._sorted = True
 
     def print_results(self, number_rows=True):
-        table = texttable.Texttable()
-        if number_rows:
-            new_rows = []
-            for i, row in enumerate(self.get_rows()):
-                new_rows.append(['#'] + row if i == 0 else [str(i)] + row)
-            table.add_rows(new_rows)
-        else:
-            table.add_rows(self.get_rows())
-        print('\n*** {} ***'.format(self.name))
-        print(table.draw())
+        self.write_results(None, number_rows, print_table=True)
 
     def write_results_to_file(self, output_dir, number_rows=True):
+        self.write_results(output_dir, number_rows)
+
+    def write_results(self, output_dir=None, number_rows=True, print_table=False):
+        """Generates the grouping's rows once, feeding them to its CSV file and/or a printed table.
+
+        The CSV is left untouched if its content would not change.
+        """
+        table = texttable.Texttable() if print_table else None
+        buf = io.StringIO(newline='') if output_dir is not None else None
+        csv_writer = csv.writer(buf) if buf is not None else None
+        for i, row in enumerate(self.iter_rows()):
+            if csv_writer is not None:
+                csv_writer.writerow(row)
+            if table is not None:
+                if number_rows:
+                    row = (['#'] if i == 0 else [str(i)]) + row
+                if i == 0:
+                    table.header(row)
+                else:
+                    table.add_row(row)
+        if table is not None:
+            print('\n*** {} ***'.format(self.name))
+            print(table.draw())
+        if buf is None:
+            return
+
         try:
             os.makedirs(output_dir)
         except FileExistsError:
             pass
-        with open(os.path.join(output_dir, self.name + '.csv'), 'w') as csvfile:
-            csv_writer = csv.writer(csvfile)
-            for row in self.get_rows():
-                csv_writer.writerow(row)
+        fpath = os.path.join(output_dir, self.name + '.csv')
+        if os.path.exists(fpath):
+            with open(fpath, 'r', newline='') as csvfile:
+                if csvfile.read() == buf.getvalue():
+                    return
+        with open(fpath, 'w', newline='') as csvfile:
+            csvfile.write(buf.getvalue())
 
     def get_rows(self):
+        return list(self.iter_rows())
+
+    def iter_rows(self):
+        """Lazily yields the header row, and then one row per card."""
         if not self._sorted:
             raise RuntimeError('Must sort Grouping "{}" before getting output'.format(self.name))
-        rows = []
-        # Create Header Row
-        header_row = []
-        for top_cell in self.columns:
-            if type(top_cell) == str:
-                header_row.append(top_cell.upper())
-            elif type(top_cell) == tuple:
-                header_row.append(''.join([word.upper() for word in top_cell]))
-        rows.append(header_row)
+        yield list(self._header_row)
+        format_row = self._format_row
         for card in self._cards:
-            new_row = []
-            for col in self.columns:
-                if type(col) == str:
-                    new_row.append(card.json[col] if col in card.json else '<N/A>')
-                elif type(col) == tuple:
-                    new_cell = ''
-                    for subcol in col:
-                        new_cell += str(card.json[subcol]) if subcol in card.json else '{}'.format(subcol)
-                    new_row.append(new_cell)
-            rows.append(new_row)
-        return rows
+            yield format_row(card.json)
+
+
+def compile_filters(filters):
+    """Returns [(KEY, VALUE, INCLUDE, BITSET), ...] for a grouping's filters.
+
+    "not_" is removed from KEY (making INCLUDE False). BITSET is (DERIVED_ATTRIBUTE, MASK) when a list filter
+    can be checked against a derived bitset (see card_attributes.BITSET_FIELDS), else None.
+    """
+    compiled = []
+    for key, value in filters.items():
+        include = not key.startswith('not_')
+        if not include:
+            key = key[4:]  # Remove "not_"
+        bitset = None
+        if key in BITSET_FIELDS and type(value) == list:
+            attribute, vocabulary = BITSET_FIELDS[key]
+            mask = symbols_to_bits(value, vocabulary)
+            if mask is not None:
+                bitset = (attribute, mask)
+        compiled.append((key, value, include, bitset))
+    return compiled
+
+
+def compile_columns(columns):
+    """Turns column specs into a header row and a function that formats a row from a card's JSON.
+
+    A column is either a Card.json key or a tuple of keys/literals whose values are concatenated. E.g.
+    ('power', '/', 'toughness') --> "2/3". A missing key outputs "<N/A>" (or the literal text in a tuple).
+    """
+    header_row = []
+    cell_formatters = []
+    for col in columns:
+        if type(col) == str:
+            header_row.append(col.upper())
+            cell_formatters.append(lambda card_json, key=col: card_json[key] if key in card_json else '<N/A>')
+        elif type(col) == tuple:
+            header_row.append(''.join([word.upper() for word in col]))
+            cell_formatters.append(lambda card_json, subcols=col: ''.join(
+                [str(card_json[subcol]) if subcol in card_json else subcol for subcol in subcols]))
+
+    def format_row(card_json):
+        return [format_cell(card_json) for format_cell in cell_formatters]
+    return header_row, format_row
 
 
 class GroupingProcessor(object):
 
-    def __init__(self, cards, output_dir, groupings=None, number_rows=True):
+    def __init__(self, cards, output_dir, groupings=None, number_rows=True, stage_cache=None, cards_key=None):
         self.cards = cards  # This is the {'card_name': Card(...)} dictionary from the Aggregator class
         self._groupings = {}  # {'grouping_name': Grouping(...)}
         self._done_processing = False
+        # When both are given, each grouping's sorted card names are memoized by the hash of the cards & its spec
+        self._stage_cache = stage_cache  # memo.StageCache
+        self._cards_key = cards_key      # Aggregator.cards_key
 
         if groupings:
             for group in groupings:
                 self.add_grouping(group)
             self.process_groupings()
-            for group in groupings:
-                group.write_results_to_file(output_dir, number_rows)
+            self.write_results(output_dir, number_rows)
 
     def add_grouping(self, grouping):
         if self._done_processing:
@@ -188,15 +260,34 @@ class GroupingProcessor(object):
     def process_groupings(self):
         if self._done_processing:
             raise RuntimeError('Already completed grouping processing')
-        for card in self.cards.values():
+        if self._stage_cache is None or self._cards_key is None:
+            self._filter_and_sort(self._groupings.values())
+        else:
             for group in self._groupings.values():
+                key = self._stage_cache.key('grouping', self._cards_key, group.spec)
+                card_names = self._stage_cache.get_or_compute(
+                    'grouping.' + group.name, key,
+                    lambda: [card.name for card in self._filter_and_sort([group])[0].cards])
+                group.set_sorted_cards(self.cards[name] for name in card_names)
+        self._done_processing = True
+
+    def write_results(self, output_dir, number_rows=True, workers=WRITER_THREADS):
+        """Writes every grouping's CSV file in parallel."""
+        with ThreadPoolExecutor(workers) as executor:
+            for _ in executor.map(lambda group: group.write_results_to_file(output_dir, number_rows),
+                                  self._groupings.values()):
+                pass
+
+    def _filter_and_sort(self, groups):
+        for card in self.cards.values():
+            for group in groups:
                 if card.name in group.force_include:
                     group.add_unconditionally(card)
                 else:
                     group.add_if_qualifies(card)
-        for group in self._groupings.values():
+        for group in groups:
             group.sort()
-        self._done_processing = True
+        return list(groups)
 
 def create_groupings(grouping_specs, num_other_cubes):
     FILTERS = 'filters'
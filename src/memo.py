@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Memoizes the results of pipeline stages on disk, keyed by hashes of the stages' inputs
+
+Configs that share a cache_dir get their own namespace (a hash of their output_dir), so the latest results of
+one config do not evict those of another.
+
+Bump STAGE_CACHE_VERSION whenever a change to the code makes previously cached stage results invalid.
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+STAGE_CACHE_VERSION = 3
+FILE_DIGESTS_FNAME = 'file_digests.json'
+_READ_CHUNK_BYTES = 1 << 20
+
+
+class StageCache(object):
+
+    def __init__(self, cache_dir, force=False, namespace=None):
+        self._cache_dir = cache_dir
+        self._force = force  # Recompute (and re-save) every stage, ignoring cached results
+        self._prefix = '{}.'.format(namespace) if namespace else ''  # Prepended to the stage file names
+        os.makedirs(cache_dir, exist_ok=True)
+        # {FILE_PATH: [SIZE, MTIME_NS, SHA1]} so unchanged files do not need to be re-read to be hashed
+        self._file_digests = {}
+        self._file_digests_changed = False
+        digests_path = os.path.join(cache_dir, FILE_DIGESTS_FNAME)
+        if os.path.exists(digests_path):
+            with open(digests_path, 'r') as fh:
+                self._file_digests = json.load(fh)
+
+    @staticmethod
+    def from_config(config, force=False):
+        namespace = hashlib.sha1(os.path.abspath(config['output_dir']).encode('utf-8')).hexdigest()[:10]
+        return StageCache(config.get('stage_cache_dir', os.path.join(config['cache_dir'], 'stages')), force, namespace)
+
+    def file_digest(self, fpath):
+        """Returns the SHA-1 of a file's contents (or None if the file does not exist)."""
+        try:
+            stat = os.stat(fpath)
+        except FileNotFoundError:
+            return None
+        abs_path = os.path.abspath(fpath)
+        cached = self._file_digests.get(abs_path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+
+        sha1 = hashlib.sha1()
+        with open(fpath, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(_READ_CHUNK_BYTES), b''):
+                sha1.update(chunk)
+        self._file_digests[abs_path] = [stat.st_size, stat.st_mtime_ns, sha1.hexdigest()]
+        self._file_digests_changed = True
+        return sha1.hexdigest()
+
+    @staticmethod
+    def key(*parts):
+        """Hashes JSON-serializable stage inputs (e.g. file digests, config values, keys of earlier stages)."""
+        text = json.dumps([STAGE_CACHE_VERSION] + list(parts), sort_keys=True, default=str)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get_or_compute(self, stage, key, compute):
+        """Returns the cached result of a stage for the key, or else computes, caches and returns it.
+
+        Only the latest result of each stage (in this namespace) is kept on disk.
+        """
+        stage = self._prefix + stage
+        fpath = os.path.join(self._cache_dir, '{}-{}.pickle'.format(stage, key))
+        if not self._force and os.path.exists(fpath):
+            with open(fpath, 'rb') as fh:
+                logging.debug('Skipping the unchanged "{}" stage'.format(stage))
+                return pickle.load(fh)
+
+        result = compute()
+        for fname in os.listdir(self._cache_dir):
+            if fname.startswith(stage + '-') and len(fname) == len(stage) + len(key) + len('-.pickle'):
+                os.remove(os.path.join(self._cache_dir, fname))
+        tmp_path = fpath + '.tmp{}'.format(os.getpid())
+        with open(tmp_path, 'wb') as fh:
+            pickle.dump(result, fh, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, fpath)
+        return result
+
+    def save(self):
+        if self._file_digests_changed:
+            with open(os.path.join(self._cache_dir, FILE_DIGESTS_FNAME), 'w') as fh:
+                json.dump(self._file_digests, fh)
+            self._file_digests_changed = False
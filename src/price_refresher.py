@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Keeps the price caches of one or more configs warm, separately from report generation
+
+Runs continuously, refreshing each card's price shortly before it would be considered outdated by
+cube_stats.py. Set "background_price_refresh: true" in a config so cube_stats.py only reads the price cache.
+
+Each web source's requests are started at least "price_request_interval" seconds apart (default:
+DEFAULT_REQUEST_INTERVAL_SECONDS), which "price_request_intervals" ({WEB_SOURCE_NAME: SECONDS}) overrides per source.
+"""
+import aggregator
+import argparse
+import card_names
+import common
+import downloaders
+import logging
+import os
+import time
+import yaml
+from datetime import datetime
+DEFAULT_REFRESH_MARGIN_DAYS = 3  # Refresh prices this many days before they are older than max_cached_days
+DEFAULT_POLL_SECONDS = 600       # How long to wait before checking again when no prices need refreshing
+DEFAULT_REQUEST_INTERVAL_SECONDS = 2  # Minimum number of seconds between the starts of two requests to a source
+SAVE_EVERY_N_CARDS = 20
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Continuously refreshes the cached prices of the cards in '
+                                     'every cube of the configs')
+    parser.add_argument(
+        '-c', '--config_paths', nargs='+', default=['inputs/vintage_cube_config.yaml'],
+        help='Paths to the configuration files')
+    parser.add_argument(
+        '-1', '--once', action='store_true', help='Refresh every outdated price once, and then exit')
+    return parser.parse_args()
+
+
+class PriceRefresher(object):
+
+    def __init__(self, configs):
+        self._configs = configs
+        all_sets_json = common.read_mtg_json_data(configs[0]['all_mtg_sets_path'])
+        self._name_index = card_names.CardNameIndex(all_sets_json, configs[0].get('card_name_aliases'))
+        self._fetchers = {}  # {PRICE_CACHE_PATH: (PriceFetcher, REFRESH_AGE_DAYS)}
+        for config in configs:
+            cache_path = os.path.join(config['cache_dir'], aggregator.PRICE_CACHE_FNAME)
+            refresh_days = config.get('max_cached_days', aggregator.DEFAULT_MAX_CACHED_DAYS) - \
+                config.get('price_refresh_margin_days', DEFAULT_REFRESH_MARGIN_DAYS)
+            pf = downloaders.PriceFetcher(cache_path, refresh_days, all_sets_json, self._name_index)
+            default_interval = max(config.get('price_request_interval', DEFAULT_REQUEST_INTERVAL_SECONDS), 0)
+            for web_source in pf.web_sources:
+                web_source.min_request_interval = config.get('price_request_intervals', {}).get(
+                    web_source.name, max(default_interval, web_source.min_request_interval))
+            self._fetchers[cache_path] = (pf, refresh_days)
+
+    def _card_names(self, cache_path):
+        """Returns the names of the cards in the cached cube lists of every config that uses the price cache."""
+        names = set()
+        for config in self._configs:
+            if os.path.join(config['cache_dir'], aggregator.PRICE_CACHE_FNAME) != cache_path:
+                continue
+            for cid in config['cubetutor_ids']:
+                fpath = downloaders.CubeTutorDownloader.get_cube_file_path(config['cache_dir'], cid)
+                if os.path.exists(fpath):
+                    with open(fpath, 'r') as fh:
+                        names.update(self._name_index.resolve(card) or card for card in common.iter_cube_list(fh))
+        return names
+
+    def _due_card_names(self, pf, refresh_days, card_names):
+        """Returns the card names whose prices cube_stats.py would not use (e.g. missing or outdated), oldest first."""
+        due = []
+        for name in card_names:
+            entry = pf.price_cache.get(name)
+            if not downloaders.is_cached_price_current(entry, refresh_days):
+                due.append((entry['date'] if entry is not None else '', name))
+        return [name for _, name in sorted(due)]
+
+    def refresh_once(self):
+        """Refreshes every due price once.
+
+        Returns:
+            The number of prices that were refreshed and are now current. Failed lookups (e.g. throttled web
+            sources, or cards that no web source knows about) keep their cached price and are not counted.
+        """
+        today = datetime.now().strftime('%Y-%m-%d')
+        num_refreshed = 0
+        for cache_path, (pf, refresh_days) in self._fetchers.items():
+            due = self._due_card_names(pf, refresh_days, self._card_names(cache_path))
+            logging.info('{} prices are due to be refreshed in {}'.format(len(due), cache_path))
+            try:
+                for i, card_name in enumerate(due):
+                    previous = pf.price_cache.get(card_name)
+                    pf.query_price(card_name)
+                    entry = pf.price_cache.get(card_name)
+                    if entry is not None and entry['date'] == today and entry['price'] is not None:
+                        # Prices that are still due (e.g. from mtgprice) are not counted, so run_forever() sleeps
+                        if downloaders.is_cached_price_current(entry, refresh_days):
+                            num_refreshed += 1
+                    elif previous is not None:
+                        # Keep the (possibly still valid) cached price instead of a failed lookup
+                        pf.price_cache[card_name] = previous
+                    elif entry is not None and entry.get('skipped_due_to_throttle'):
+                        # Leave the card due, so it is retried once the web sources stop throttling
+                        del pf.price_cache[card_name]
+                    if (i + 1) % SAVE_EVERY_N_CARDS == 0:
+                        pf.save(backup=False)
+            finally:
+                # Merges in the prices saved by other processes, so the next loop does not refresh them again
+                pf.save(backup=False)
+        return num_refreshed
+
+    def run_forever(self, poll_seconds=DEFAULT_POLL_SECONDS):
+        while True:
+            if self.refresh_once() == 0:
+                time.sleep(poll_seconds)
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO)
+    configs = []
+    for config_path in args.config_paths:
+        with open(config_path, 'r') as fh:
+            configs.append(yaml.load(fh.read()))
+    refresher = PriceRefresher(configs)
+    if args.once:
+        refresher.refresh_once()
+    else:
+        refresher.run_forever(configs[0].get('price_refresh_poll_seconds', DEFAULT_POLL_SECONDS))
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Finds the cubetutor cubes most similar to a cube (and clusters cubes) using MinHash signatures + LSH
+
+The Jaccard similarity of two cubes (size of the intersection of their card lists / size of the union)
+is estimated from MinHash signatures. The standard error of the estimate is about 1 / sqrt(num_perm),
+so num_perm is derived from the configured "similarity_max_error".
+"""
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import math
+import os
+import random
+import yaml
+from common import iter_cube_list
+DEFAULT_MAX_ERROR = 0.1
+DEFAULT_LSH_THRESHOLD = 0.5
+SIGNATURE_CACHE_FNAME = 'minhash_signatures.json'
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+def _hash_card(card_name):
+    return int.from_bytes(hashlib.blake2b(card_name.lower().encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def num_perm_for_error(max_error):
+    return int(math.ceil(1 / max_error ** 2))
+
+
+def choose_bands(num_perm, threshold):
+    """Returns the (bands, rows) such that candidate pairs are those with Jaccard above roughly the threshold."""
+    best = None
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class MinHashIndex(object):
+
+    def __init__(self, max_error=DEFAULT_MAX_ERROR, threshold=DEFAULT_LSH_THRESHOLD, seed=1):
+        self.num_perm = num_perm_for_error(max_error)
+        self.threshold = threshold
+        self._bands, self._rows = choose_bands(self.num_perm, threshold)
+        rng = random.Random(seed)
+        self._perms = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+                       for _ in range(self.num_perm)]
+        self.signatures = {}  # {KEY: [MIN_HASH_1, MIN_HASH_2, ...]}
+        self._buckets = [{} for _ in range(self._bands)]  # [{BAND_TUPLE: [KEY, ...]}, ...]
+
+    def signature(self, card_names):
+        hashes = {_hash_card(name) for name in card_names}
+        if not hashes:
+            return [_MERSENNE_PRIME] * self.num_perm
+        return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in self._perms]
+
+    def _bands_of(self, sig):
+        for i in range(self._bands):
+            yield i, tuple(sig[i * self._rows:(i + 1) * self._rows])
+
+    def add(self, key, card_names=None, sig=None):
+        if sig is None:
+            sig = self.signature(card_names)
+        self.signatures[key] = sig
+        for i, band in self._bands_of(sig):
+            self._buckets[i].setdefault(band, []).append(key)
+
+    def estimate_jaccard(self, sig1, sig2):
+        return sum(1 for x, y in zip(sig1, sig2) if x == y) / self.num_perm
+
+    def candidates(self, sig):
+        found = set()
+        for i, band in self._bands_of(sig):
+            found.update(self._buckets[i].get(band, ()))
+        return found
+
+    def query(self, card_names, top_n=10):
+        """Returns up to top_n [(KEY, ESTIMATED_JACCARD), ...] for the indexed cubes most similar to card_names."""
+        sig = self.signature(card_names)
+        keys = self.candidates(sig)
+        if len(keys) < top_n:  # Too few LSH candidates, so rank everything
+            keys = self.signatures.keys()
+        ranked = [(key, self.estimate_jaccard(sig, self.signatures[key])) for key in keys]
+        ranked.sort(key=lambda item: item[1], reverse=True)
+        return ranked[:top_n]
+
+    def clusters(self, threshold=None):
+        """Groups the indexed cubes so that each cube shares a cluster with the cubes it is similar to.
+
+        Returns:
+            A list of clusters (each a sorted list of keys), largest first
+        """
+        threshold = self.threshold if threshold is None else threshold
+        parent = {key: key for key in self.signatures}
+
+        def find(key):
+            while parent[key] != key:
+                parent[key] = parent[parent[key]]
+                key = parent[key]
+            return key
+
+        for buckets in self._buckets:
+            for keys in buckets.values():
+                for i, key1 in enumerate(keys):
+                    for key2 in keys[i + 1:]:
+                        if find(key1) != find(key2) and \
+                                self.estimate_jaccard(self.signatures[key1], self.signatures[key2]) >= threshold:
+                            parent[find(key1)] = find(key2)
+
+        groups = {}
+        for key in self.signatures:
+            groups.setdefault(find(key), []).append(key)
+        return sorted([sorted(group) for group in groups.values()], key=len, reverse=True)
+
+
+def read_my_cube_csv(csv_path):
+    """Reads the card names from one of my cube lists (a CSV whose header row is "NAME, GROUP, MORE")."""
+    with open(csv_path) as csvfile:
+        return [row[0] for i, row in enumerate(csv.reader(csvfile)) if i > 0 and row]
+
+
+def build_index_from_cache_dir(cache_dir, max_error=DEFAULT_MAX_ERROR, threshold=DEFAULT_LSH_THRESHOLD):
+    """Indexes every cube list cached by CubeTutorDownloader in cache_dir.
+
+    Signatures are saved in the cache_dir and only recomputed for cube lists whose contents changed.
+
+    Returns:
+        A tuple of (the MinHashIndex keyed by cube ID, {CUBE_ID: CUBE_NAME})
+    """
+    index = MinHashIndex(max_error, threshold)
+    cache_path = os.path.join(cache_dir, SIGNATURE_CACHE_FNAME)
+    sig_cache = {}  # {CUBE_ID: {'digest': <>, 'num_perm': <>, 'sig': [...]}}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as fh:
+            sig_cache = json.load(fh)
+
+    cube_names = {}
+    new_cache = {}
+    for fpath in sorted(glob.glob(os.path.join(cache_dir, '*.txt'))):
+        cube_id = os.path.basename(fpath).rsplit('.', 1)[0]
+        with open(fpath, 'r') as fh:
+            text = fh.read()
+        first_line = text.split('\n', 1)[0]
+        cube_names[cube_id] = first_line[1:].strip() if first_line.startswith('#') else cube_id
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+        entry = sig_cache.get(cube_id)
+        if entry is None or entry['digest'] != digest or entry['num_perm'] != index.num_perm:
+            sig = index.signature(iter_cube_list(text.splitlines(True)))
+            entry = {'digest': digest, 'num_perm': index.num_perm, 'sig': sig}
+        index.add(cube_id, sig=entry['sig'])
+        new_cache[cube_id] = entry
+
+    if new_cache != sig_cache:
+        with open(cache_path, 'w') as fh:
+            json.dump(new_cache, fh)
+    return index, cube_names
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Finds the cached cubetutor cubes that are most similar to one '
+                                     'of my cubes, or clusters all of the cached cubetutor cubes')
+    parser.add_argument(
+        '-c', '--config_path', default='inputs/vintage_cube_config.yaml',
+        help='Path to the configuration file')
+    parser.add_argument('-m', '--my_cube', help='Path to one of my cube lists (e.g. inputs/my_legacy_cube.csv)')
+    parser.add_argument('-n', '--num_results', type=int, default=20, help='Number of similar cubes to show')
+    parser.add_argument('--clusters', action='store_true', help='Cluster all of the cached cubetutor cubes')
+    return parser.parse_args()
+
+
+def main(args):
+    with open(args.config_path, 'r') as fh:
+        config = yaml.load(fh.read())
+    index, cube_names = build_index_from_cache_dir(
+        config['cache_dir'], config.get('similarity_max_error', DEFAULT_MAX_ERROR),
+        config.get('similarity_threshold', DEFAULT_LSH_THRESHOLD))
+
+    if args.my_cube:
+        print('\n*** Cubes most similar to {} ***'.format(args.my_cube))
+        for cube_id, jaccard in index.query(read_my_cube_csv(args.my_cube), args.num_results):
+            print('  {:.2f}  {}: {}'.format(jaccard, cube_id, cube_names[cube_id]))
+    if args.clusters:
+        for i, cluster in enumerate(index.clusters()):
+            print('\n*** Cluster {} ***'.format(i + 1))
+            for cube_id in cluster:
+                print('  {}: {}'.format(cube_id, cube_names[cube_id]))
+
+
+if __name__ == '__main__':
+    main(parse_args())
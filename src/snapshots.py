@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Versioned store of the cube lists downloaded from cubetutor.com
+
+Layout of the store directory:
+    cards.json          Every distinct card line seen in any snapshot. A card's ID is its index in this list.
+    index.json          {CUBE_ID: [[TIMESTAMP, SNAPSHOT_HASH], ...]}  (oldest snapshot first)
+    objects/<HASH>.json One file per distinct cube list, named by the SHA-1 of the raw downloaded text:
+                        {'cube_name': <>, 'cards': [[CARD_ID, COUNT], ...]}
+"""
+import argparse
+import bisect
+import common
+import hashlib
+import json
+import os
+import yaml
+from collections import Counter
+from datetime import datetime
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def date_arg(text):
+    """argparse type for YYYY-MM-DD dates."""
+    try:
+        datetime.strptime(text, DATE_FORMAT)
+    except ValueError:
+        raise argparse.ArgumentTypeError('"{}" is not a YYYY-MM-DD date'.format(text))
+    return text
+
+
+class SnapshotStore(object):
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self._objects_dir = os.path.join(store_dir, 'objects')
+        os.makedirs(self._objects_dir, exist_ok=True)
+        self._card_names = self._read_json('cards.json', [])  # [CARD_NAME, ...]
+        self._card_ids = {name: i for i, name in enumerate(self._card_names)}  # {CARD_NAME: CARD_ID}
+        self._index = self._read_json('index.json', {})
+        self._loaded = {}  # {SNAPSHOT_HASH: Counter({CARD_ID: COUNT})}
+
+    @staticmethod
+    def from_config(config):
+        return SnapshotStore(config.get('snapshot_dir', os.path.join(config['cache_dir'], 'snapshots')))
+
+    def _read_json(self, fname, default):
+        fpath = os.path.join(self.store_dir, fname)
+        if not os.path.exists(fpath):
+            return default
+        with open(fpath, 'r') as fh:
+            return json.load(fh)
+
+    def _object_path(self, snapshot_hash):
+        return os.path.join(self._objects_dir, snapshot_hash + '.json')
+
+    def _intern(self, card_name):
+        if card_name not in self._card_ids:
+            self._card_ids[card_name] = len(self._card_names)
+            self._card_names.append(card_name)
+        return self._card_ids[card_name]
+
+    def add_snapshot(self, cube_id, cube_path, timestamp=None):
+        """Records the cube list at cube_path, unless it is identical to the cube's latest snapshot.
+
+        The snapshot is timestamped with the file's modification time (i.e. when it was downloaded), unless a
+        timestamp is passed in.
+
+        Returns:
+            The snapshot hash of the cube list
+        """
+        with open(cube_path, 'rb') as fh:
+            raw = fh.read()
+        snapshot_hash = hashlib.sha1(raw).hexdigest()
+        history = self._index.setdefault(str(cube_id), [])
+        if history and history[-1][1] == snapshot_hash:
+            return snapshot_hash
+
+        if not os.path.exists(self._object_path(snapshot_hash)):
+            text = raw.decode('utf-8')
+            first_line = text.split('\n', 1)[0]
+            cube_name = first_line[1:].strip() if first_line.startswith('#') else None
+            counts = Counter(self._intern(card) for card in common.iter_cube_list(text.splitlines(True)))
+            common.atomic_write(os.path.join(self.store_dir, 'cards.json'), json.dumps(self._card_names))
+            common.atomic_write(self._object_path(snapshot_hash), json.dumps(
+                {'cube_name': cube_name, 'cards': sorted(counts.items())}))
+            self._loaded[snapshot_hash] = counts
+
+        if timestamp is None:
+            timestamp = datetime.fromtimestamp(os.path.getmtime(cube_path)).strftime(TIMESTAMP_FORMAT)
+        bisect.insort(history, [timestamp, snapshot_hash])  # Kept sorted for snapshot_as_of()
+        common.atomic_write(os.path.join(self.store_dir, 'index.json'), json.dumps(self._index, indent=1))
+        return snapshot_hash
+
+    def snapshot_as_of(self, cube_id, as_of):
+        """Returns the hash of the latest snapshot of a cube taken on or before as_of (YYYY-MM-DD), or None."""
+        history = self._index.get(str(cube_id), [])
+        i = bisect.bisect_right([ts[:10] for ts, _ in history], as_of)
+        return history[i - 1][1] if i > 0 else None
+
+    def _load(self, snapshot_hash):
+        if snapshot_hash not in self._loaded:
+            with open(self._object_path(snapshot_hash), 'r') as fh:
+                self._loaded[snapshot_hash] = Counter(dict(json.load(fh)['cards']))
+        return self._loaded[snapshot_hash]
+
+    def _counts_as_of(self, cube_id, as_of):
+        snapshot_hash = self.snapshot_as_of(cube_id, as_of)
+        return self._load(snapshot_hash) if snapshot_hash else Counter()
+
+    def cube_counts_as_of(self, cube_id, as_of):
+        """Returns {CARD_NAME: COUNT} for a cube's list as it was on the as_of date."""
+        return {self._card_names[card_id]: count for card_id, count in self._counts_as_of(cube_id, as_of).items()}
+
+    def count_cards_as_of(self, cube_ids, as_of):
+        """The same as Aggregator._count_cards(), but for the cube lists as they were on the as_of date.
+
+        Returns:
+            A tuple of (the number of cubes that had a snapshot, a dictionary mapping card name to occurrences)
+        """
+        num_cubes = 0
+        id_counts = Counter()
+        for cid in cube_ids:
+            snapshot_hash = self.snapshot_as_of(cid, as_of)
+            if snapshot_hash is None:
+                continue
+            num_cubes += 1
+            id_counts.update(self._load(snapshot_hash))
+        return num_cubes, {self._card_names[card_id]: count for card_id, count in id_counts.items()}
+
+    def diff_cube(self, cube_id, since, until):
+        """Returns the (adds, cuts) of a cube between two dates, each as a {CARD_NAME: COUNT} dictionary."""
+        before = self._counts_as_of(cube_id, since)
+        after = self._counts_as_of(cube_id, until)
+        adds = {self._card_names[card_id]: count for card_id, count in (after - before).items()}
+        cuts = {self._card_names[card_id]: count for card_id, count in (before - after).items()}
+        return adds, cuts
+
+    def diff_all(self, since, until, cube_ids=None):
+        """Diffs every cube (or only cube_ids) between two dates.
+
+        Returns:
+            A tuple of
+              - {CUBE_ID: (adds, cuts)} for every cube that changed
+              - {CARD_NAME: [NUM_CUBES_ADDED_TO, NUM_CUBES_CUT_FROM]} across all of the cubes
+        """
+        per_cube = {}
+        per_card = {}
+        for cid in (cube_ids if cube_ids is not None else self._index.keys()):
+            if self.snapshot_as_of(cid, since) == self.snapshot_as_of(cid, until):
+                continue
+            adds, cuts = self.diff_cube(cid, since, until)
+            per_cube[str(cid)] = (adds, cuts)
+            for card in adds:
+                per_card.setdefault(card, [0, 0])[0] += 1
+            for card in cuts:
+                per_card.setdefault(card, [0, 0])[1] += 1
+        return per_cube, per_card
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Shows the adds and cuts made to cubetutor cubes between two dates')
+    parser.add_argument('since', type=date_arg, help='Start date (YYYY-MM-DD)')
+    parser.add_argument('until', type=date_arg, nargs='?', default=datetime.now().strftime(DATE_FORMAT),
+                        help='End date (YYYY-MM-DD). Defaults to today.')
+    parser.add_argument(
+        '-c', '--config_path', default='inputs/vintage_cube_config.yaml',
+        help='Path to the configuration file')
+    return parser.parse_args()
+
+
+def main(args):
+    with open(args.config_path, 'r') as fh:
+        config = yaml.load(fh.read())
+    store = SnapshotStore.from_config(config)
+    per_cube, per_card = store.diff_all(args.since, args.until, [str(cid) for cid in config['cubetutor_ids']])
+
+    for cid, (adds, cuts) in per_cube.items():
+        print('\n*** {} ({}) ***'.format(config['cubetutor_ids'].get(int(cid), cid), cid))
+        for card in sorted(adds):
+            print('  + {}'.format(card))
+        for card in sorted(cuts):
+            print('  - {}'.format(card))
+
+    print('\n*** All Cubes (+added / -cut) ***')
+    for card, (added, cut) in sorted(per_card.items(), key=lambda item: (item[1][1] - item[1][0], item[0])):
+        print('  +{} / -{}  {}'.format(added, cut, card))
+
+
+if __name__ == '__main__':
+    main(parse_args())
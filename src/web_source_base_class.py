@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import abc
+import card_names
+import codecs
+import itertools
 import logging
 import requests
 import time
 from datetime import datetime
 from datetime import timedelta
 INITIAL_THROTTLE_SECONDS = 5
+STREAM_CHUNK_BYTES = 8 * 1024
+THROTTLED_MARKER = 'Throttled'
+NOT_FOUND_MARKER = 'That page was not found.'
+EMPTY_TITLE_MARKER = '<title></title>'
 
 
 SKIPPED_SETS_PARTIAL_NAME = [
@@ -19,7 +26,32 @@ SKIPPED_SETS_FULL_NAMES = [
     'Arena League 2004', 'Avacyn Restored Promos', 'Commander Anthology Volume II',
 ]
 
+class StreamedResponse(object):
+    """The part of an HTTP response that WebSource.make_http_request() read before closing the connection.
+
+    Has the url, status_code and text attributes of a requests.Response, so it can be passed to
+    parse_url_response(). When a WebSource has a price_pattern, price is the price found in the body and
+    text may stop right after it.
+    """
+
+    def __init__(self, url, status_code, text, price=None, marker=None):
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+        self.price = price
+        self.marker = marker  # The throttle/error marker that was found in the body (if any)
+
+    @property
+    def content(self):
+        return self.text.encode('utf-8')
+
+
 class WebSource(abc.ABC):
+    # Subclasses can set a compiled regex whose first group is the price on a product page. The body of the
+    # page is then only read until the price is found. Otherwise parse_url_response() gets the whole page.
+    price_pattern = None
+    max_price_match_chars = 256  # Longest text that price_pattern can match
+    min_request_interval = 0     # Minimum number of seconds between the starts of two requests to this source
 
     def __init__(self, all_sets_json, throttle_mult=2):
         self.name = 'ABSTRACT_CLASS'
@@ -29,6 +61,7 @@ class WebSource(abc.ABC):
         self._current_throttle_in_sec = INITIAL_THROTTLE_SECONDS
         self._throttle_mult = throttle_mult
         self._throttle_end_time = None
+        self._last_request_time = None
 
     @abc.abstractmethod
     def _create_card_url(self, card_name, set_name):
@@ -42,6 +75,10 @@ class WebSource(abc.ABC):
     def get_setname(self, set_name):
         pass
 
+    def web_card_name(self, card_name):
+        """Returns the spelling of a card name that this web source uses in its URLs."""
+        return card_name.replace('Aether', 'AEther')
+
     @property
     def is_throttled(self):
         return self._throttle_end_time is not None
@@ -52,15 +89,19 @@ class WebSource(abc.ABC):
             return None  # Continue throttling
 
         self.last_response = None
-        url = self._create_card_url(card_name, set_name)
+        url = self._create_card_url(self.web_card_name(card_name), set_name)
+        if self._last_request_time is not None:
+            time.sleep(max(0, self._last_request_time + self.min_request_interval - time.time()))
+        self._last_request_time = time.time()
         try:
-            resp = requests.get(url)
+            with requests.get(url, stream=True) as raw_resp:
+                resp = self._read_response(raw_resp)
             self.last_response = resp
         except requests.exceptions.SSLError as e:
             logging.error(e)
             return
 
-        if resp.status_code == 429 or 'Throttled' in resp.text:
+        if resp.status_code == 429 or resp.marker == THROTTLED_MARKER:
             if self._throttle_end_time:  # Here, we only recently tried another request after throttling
                 self._current_throttle_in_sec *= self._throttle_mult
             logging.warn('Throttle encountered for: {}'.format(url))
@@ -70,10 +111,10 @@ class WebSource(abc.ABC):
         if resp.status_code != 200:
             logging.warn('\tThe following URL produced status_code={0}: {1}'.format(resp.status_code, url))
             return None
-        if 'That page was not found.' in resp.text:
+        if resp.marker == NOT_FOUND_MARKER:
             logging.warn('\tThe following URL resulted in "That page was not found.": {0}'.format(url))
             return None
-        if '<title></title>' in resp.text:
+        if resp.marker == EMPTY_TITLE_MARKER:
             logging.warn('\tThe following URL contained "<title></title>": {0}'.format(url))
             return None
         
@@ -83,6 +124,45 @@ class WebSource(abc.ABC):
             self._throttle_end_time = None
         return resp
 
+    def _read_response(self, raw_resp):
+        """Reads the body of a streamed requests.Response chunk by chunk.
+
+        Stops reading (which closes the connection early) as soon as the outcome is known: a throttle or
+        error marker appears, or the price_pattern matches. Each chunk is only searched together with
+        a short tail of the previous text, so matches spanning two chunks are still found. A price match is
+        only accepted once max_price_match_chars more characters have been read after it (or the body has
+        ended), since a match at the end of the text read so far may be cut short (E.g. "$12" of "$1234.50").
+        """
+        decoder = codecs.getincrementaldecoder(raw_resp.encoding or 'utf-8')(errors='replace')
+        markers = [THROTTLED_MARKER]
+        if raw_resp.status_code == 200:
+            markers += [NOT_FOUND_MARKER, EMPTY_TITLE_MARKER]
+        pattern = self.price_pattern if raw_resp.status_code == 200 else None
+        # A price match that is not accepted yet ends in the last max_price_match_chars, so it starts in the last
+        # 2 * max_price_match_chars
+        overlap = max([len(marker) for marker in markers] + [2 * self.max_price_match_chars if pattern else 0])
+
+        parts = []
+        tail = ''
+        for chunk in itertools.chain(raw_resp.iter_content(STREAM_CHUNK_BYTES), [None]):
+            is_last = chunk is None
+            new_text = decoder.decode(b'', final=True) if is_last else decoder.decode(chunk)
+            parts.append(new_text)
+            tail = tail[-overlap:] + new_text
+            found = [marker for marker in markers if marker in tail]
+            if found:
+                return StreamedResponse(raw_resp.url, raw_resp.status_code, ''.join(parts), marker=found[0])
+            if pattern is not None:
+                match = pattern.search(tail)
+                if match and (is_last or match.end() <= len(tail) - self.max_price_match_chars):
+                    return StreamedResponse(
+                        raw_resp.url, raw_resp.status_code, ''.join(parts), self.parse_price_match(match))
+        return StreamedResponse(raw_resp.url, raw_resp.status_code, ''.join(parts))
+
+    def parse_price_match(self, match):
+        """Converts a match of price_pattern to a price. E.g. "1,234.50" --> 1234.5"""
+        return float(match.group(1).replace(',', ''))
+
     def _create_setname_map(self, all_sets_json):
         setname_map = {}  
         for set_ in all_sets_json.values():
@@ -93,14 +173,15 @@ class WebSource(abc.ABC):
             setname = self.get_setname(set_['name'])
 
             for card in set_['cards']:
-                cardname = card['name']
+                # Keyed by the CardNameIndex's canonical name, so both halves of a split card share an entry
+                cardname = card_names.canonical_catalogue_name(card)
                 if cardname in ['Plains', 'Island', 'Swamp', 'Mountain', 'Forest']:
                     continue
-                cardname = cardname.replace('Aether', 'AEther')
 
                 if setname is not None:
                     if cardname in setname_map:
-                        setname_map[cardname].append(setname)
+                        if setname_map[cardname][-1] != setname:
+                            setname_map[cardname].append(setname)
                     else:
                         setname_map[cardname] = [setname]
         return setname_map
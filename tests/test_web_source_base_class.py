@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import web_source_base_class
+
+
+class FakeRawResponse(object):
+
+    def __init__(self, chunks, status_code=200):
+        self.url = 'https://example.com/card'
+        self.status_code = status_code
+        self.encoding = 'utf-8'
+        self._chunks = chunks
+        self.chunks_read = 0
+
+    def iter_content(self, chunk_size):
+        for chunk in self._chunks:
+            self.chunks_read += 1
+            yield chunk
+
+
+class FakeWebSource(web_source_base_class.WebSource):
+    price_pattern = re.compile(r'\$([\d,]+\.?\d*)')
+    max_price_match_chars = 16
+
+    def __init__(self):
+        super().__init__({})
+        self.name = 'fake'
+
+    def _create_card_url(self, card_name, set_name):
+        return 'https://example.com/card'
+
+    def parse_url_response(self, response):
+        return None
+
+    def get_setname(self, set_name):
+        return set_name
+
+
+class ReadResponseTest(unittest.TestCase):
+
+    def test_price_split_across_chunks(self):
+        raw = FakeRawResponse([b'<html>price: $12', b'34.50 per card</html>'])
+        self.assertEqual(FakeWebSource()._read_response(raw).price, 1234.5)
+
+    def test_price_at_end_of_body(self):
+        raw = FakeRawResponse([b'<html>price: $12', b'34.50'])
+        self.assertEqual(FakeWebSource()._read_response(raw).price, 1234.5)
+
+    def test_stops_reading_after_price(self):
+        raw = FakeRawResponse([b'price: $1,234.50' + b' ' * 32, b'more', b'even more'])
+        resp = FakeWebSource()._read_response(raw)
+        self.assertEqual(resp.price, 1234.5)
+        self.assertEqual(raw.chunks_read, 1)
+
+    def test_marker_split_across_chunks(self):
+        raw = FakeRawResponse([b'<html>Thrott', b'led</html>'])
+        resp = FakeWebSource()._read_response(raw)
+        self.assertEqual(resp.marker, web_source_base_class.THROTTLED_MARKER)
+        self.assertIsNone(resp.price)
+
+
+if __name__ == '__main__':
+    unittest.main()